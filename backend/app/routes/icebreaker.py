@@ -7,7 +7,7 @@ from pydantic import BaseModel, Field
 from typing import List, Optional
 from app.utils.auth import get_current_user
 from app.services.firebase_service import get_firebase_service
-from app.services.ai_service import get_ai_service
+from app.services.ai_service import get_ai_service, profile_tag_ids
 
 
 # Router instance
@@ -115,6 +115,9 @@ async def generate_icebreaker(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Recipient profile not found"
         )
+    # Keyed by uid so tag ids can be read from the recommender's user store
+    sender_profile.setdefault('uid', sender_id)
+    recipient_profile.setdefault('uid', recipient_id)
     
     # Get AI service
     ai_service = get_ai_service()
@@ -149,10 +152,11 @@ async def generate_icebreaker(
             "email": sender_profile.get('email')
         }
         
+        (recipient_ids,), vocabulary = profile_tag_ids(recipient_profile)
         recipient_info = {
             "uid": recipient_id,
             "name": recipient_profile.get('name', 'Unknown'),
-            "interests": recipient_profile.get('interest_tags', '').split(',') if recipient_profile.get('interest_tags') else []
+            "interests": vocabulary.labels_of(recipient_ids)
         }
         
         return IcebreakerResponse(
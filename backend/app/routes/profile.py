@@ -7,6 +7,15 @@ from pydantic import BaseModel, Field
 from typing import Optional, List
 from app.utils.auth import get_current_user
 from app.services.firebase_service import get_firebase_service
+from app.utils.profile import utc_timestamp
+from app.utils.geo_index import resolve_location
+
+# Recommender import is optional (sklearn may be unavailable), see main.py
+try:
+    from app.routes.recommend import update_recommender_profile
+except Exception as e:
+    print(f"⚠️  Warning: Profile edits will not update recommender: {e}")
+    update_recommender_profile = None
 
 router = APIRouter(
     prefix="/api/profile",
@@ -79,6 +88,14 @@ async def update_my_profile(
             detail="No valid fields to update"
         )
     
+    # Resolve a new city to coordinates once, here, for the distance filter
+    if 'location' in update_data:
+        coords = resolve_location(update_data['location'])
+        update_data['latitude'], update_data['longitude'] = coords if coords else (None, None)
+    
+    # Change-feed cursor for the recommender refresher
+    update_data['updatedAt'] = utc_timestamp()
+    
     # Update profile in Firestore
     try:
         db = firebase_service.db
@@ -88,6 +105,13 @@ async def update_my_profile(
         # Get updated profile
         updated_profile = await firebase_service.get_user_profile(user['uid'])
         
+        # Keep the recommender in step without a full refit
+        if update_recommender_profile is not None:
+            try:
+                update_recommender_profile(user['uid'], updated_profile)
+            except Exception as e:
+                print(f"Error updating recommender for {user['uid']}: {str(e)}")
+        
         return {
             "success": True,
             "message": "Profile updated successfully",
@@ -2,13 +2,18 @@
 Recommendation API endpoints
 """
 from fastapi import APIRouter, Depends, HTTPException, status
-from typing import List, Optional
+from fastapi.responses import StreamingResponse
+from typing import List, Optional, Dict, Any
 from pydantic import BaseModel
-import pandas as pd
+import asyncio
+import json
+import time
 
 from app.utils.auth import get_current_user
-from app.utils.profile import get_all_user_profiles
-from app.utils.recommend import HybridRecommender
+from app.services.recommender_service import get_recommender_service
+from app.services.firebase_service import get_firebase_service
+from app.utils.profile import utc_timestamp
+from app.utils.ranking_cache import encode_cursor, decode_cursor, InvalidCursor
 
 router = APIRouter(
     prefix="/api/recommendations",
@@ -23,53 +28,98 @@ class MatchRecommendation(BaseModel):
     age: int
     interest_tags: str
     similarity_score: float
+    rank_score: Optional[float] = None
 
 class RecommendationsResponse(BaseModel):
     success: bool
     matches: List[MatchRecommendation]
     total: int
+    latency_ms: Optional[float] = None
+    timings: Optional[Dict[str, Any]] = None
+    next_cursor: Optional[str] = None
 
-# Global recommender instance (will be reinitialized when needed)
-_recommender = None
-_last_profile_count = 0
+class BatchRecommendationsRequest(BaseModel):
+    uids: List[str]
+    top_n: int = 10
 
-def get_recommender():
-    """Get or create recommender instance"""
-    global _recommender, _last_profile_count
-    
-    # Get all profiles
-    profiles = get_all_user_profiles()
-    
-    if not profiles:
+# Largest radius /matches accepts (bounds the grid cells scanned per query)
+MAX_DISTANCE_KM = 500
+
+# Upper bound on uids per batch request (digest jobs page through users)
+MAX_BATCH_UIDS = 10000
+
+def start_recommender_refresher():
+    """Start loading/fitting the recommender in the background (app startup)"""
+    get_recommender_service().start()
+
+async def resolve_regions(uids: List[str]):
+    """
+    The recommender service, with the region of every uid known (regional
+    mode); locations not cached yet are read in the executor, in batches
+    """
+    service = get_recommender_service()
+    missing = service.missing_regions(uids)
+    if missing:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, service.resolve_regions, missing)
+    return service
+
+async def get_service(uid: str):
+    """The service whose model serves a user (their region's in regional mode)"""
+    service = await resolve_regions([uid])
+    return service.service_for(uid)
+
+async def get_recommender(uid: str):
+    """
+    Get the live recommender instance serving a user (their region's model
+    in regional mode)
+
+    Models are loaded, fitted and hot-swapped by RecommenderService in the
+    background; this never reads the profiles collection on the event loop.
+    """
+    recommender = (await get_service(uid)).get_recommender()
+    if recommender is None:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="No user profiles found in database"
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Recommender is warming up, please retry shortly"
         )
-    
-    # Reinitialize if profile count changed (new users registered)
-    if _recommender is None or len(profiles) != _last_profile_count:
-        print(f"Initializing recommender with {len(profiles)} profiles...")
-        profiles_df = pd.DataFrame(profiles)
-        _recommender = HybridRecommender(profiles_df)
-        _recommender.fit()
-        _last_profile_count = len(profiles)
-        print("Recommender initialized successfully")
-    
-    return _recommender
+    return recommender
+
+def update_recommender_profile(uid: str, profile: dict):
+    """
+    Push a single edited profile into the live recommender
+    No-op until the model has been built (the first build reads fresh data)
+    """
+    get_recommender_service().update_profile(uid, profile)
 
 @router.get("/matches", response_model=RecommendationsResponse)
 async def get_match_recommendations(
     top_n: int = 10,
+    ann: bool = False,
+    rerank: bool = True,
+    cursor: Optional[str] = None,
+    max_distance_km: Optional[float] = None,
+    min_age: Optional[int] = None,
+    max_age: Optional[int] = None,
+    shared_tags: Optional[int] = None,
     user: dict = Depends(get_current_user)
 ):
     """
     Get personalized match recommendations for the current user
     
     Parameters:
-    - top_n: Number of recommendations to return (default: 10, max: 50)
+    - top_n: Page size (default: 10, max: 50)
+    - ann: Use approximate nearest-neighbor retrieval (LSH) instead of exact scoring
+    - rerank: Re-rank the retrieved candidates with engagement features (two-stage)
+    - cursor: next_cursor from the previous page
+    - max_distance_km: Only users within this distance (ignored if your location is unknown)
+    - min_age / max_age: Only users in this age range (inclusive)
+    - shared_tags: Only score users sharing at least this many interest tags
+      (falls back to everyone when too few do)
     
     Returns:
-    - List of recommended matches with similarity scores
+    - List of recommended matches with similarity (and re-rank) scores,
+      per-stage timings, and a cursor for the next page (null on the last one)
     """
     try:
         # Validate top_n
@@ -78,40 +128,61 @@ async def get_match_recommendations(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="top_n must be between 1 and 50"
             )
+        if max_distance_km is not None and not 0 < max_distance_km <= MAX_DISTANCE_KM:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"max_distance_km must be between 0 and {MAX_DISTANCE_KM}"
+            )
+        if min_age is not None and max_age is not None and min_age > max_age:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="min_age must not be greater than max_age"
+            )
+        if shared_tags is not None and shared_tags < 1:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="shared_tags must be at least 1"
+            )
         
-        user_id = user['uid']
+        offset = 0
+        if cursor:
+            try:
+                # A cursor from an older model generation restarts at the same offset
+                _, offset = decode_cursor(cursor)
+            except InvalidCursor as e:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=str(e)
+                )
         
-        # Get recommender instance
-        recommender = get_recommender()
+        user_id = user['uid']
         
-        # Get recommendations
-        recommendations_df = recommender.recommend(user_id, top_n=top_n)
+        # Get recommender instance (ann falls back to exact scoring when the
+        # model was built without an LSH index)
+        recommender = await get_recommender(user_id)
         
-        if recommendations_df.empty:
-            return RecommendationsResponse(
-                success=True,
-                matches=[],
-                total=0
-            )
+        # Pages are slices of the user's cached ranking (plain records, best first)
+        start = time.perf_counter()
+        recommendations, next_offset, timings = (await get_service(user_id)).ranking_cache.page(
+            recommender, user_id, offset, top_n, rerank=rerank,
+            use_ann=ann, max_distance_km=max_distance_km, min_age=min_age, max_age=max_age,
+            min_shared_tags=shared_tags
+        )
+        latency_ms = 1000 * (time.perf_counter() - start)
         
-        # Convert DataFrame to list of dicts
-        matches = []
-        for _, row in recommendations_df.iterrows():
-            matches.append(MatchRecommendation(
-                uid=row['uid'],
-                name=row['name'],
-                gender=row['gender'],
-                age=int(row['age']),
-                interest_tags=row['interest_tags'],
-                similarity_score=float(row['similarity_score'])
-            ))
+        matches = [MatchRecommendation(**record) for record in recommendations]
         
         return RecommendationsResponse(
             success=True,
             matches=matches,
-            total=len(matches)
+            total=len(matches),
+            latency_ms=latency_ms,
+            timings=timings,
+            next_cursor=encode_cursor(recommender.generation, next_offset) if next_offset is not None else None
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error getting recommendations: {str(e)}")
         raise HTTPException(
@@ -119,31 +190,196 @@ async def get_match_recommendations(
             detail=f"Failed to generate recommendations: {str(e)}"
         )
 
-@router.post("/refresh")
-async def refresh_recommender(user: dict = Depends(get_current_user)):
+@router.post("/skip/{skipped_uid}")
+async def skip_match(
+    skipped_uid: str,
+    user: dict = Depends(get_current_user)
+):
     """
-    Force refresh the recommender model (useful after new users register)
+    Never recommend skipped_uid to the current user again
+    (users with a conversation are excluded automatically)
+    """
+    if skipped_uid == user['uid']:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Cannot skip yourself"
+        )
+    
+    try:
+        db = get_firebase_service().db
+        db.collection('skips').document(f"{user['uid']}_{skipped_uid}").set({
+            'uid': user['uid'],
+            'skipped_uid': skipped_uid,
+            'createdAt': utc_timestamp()
+        })
+        get_recommender_service().skip(user['uid'], skipped_uid)
+        
+        return {
+            "success": True,
+            "message": "User skipped"
+        }
+        
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to skip user: {str(e)}"
+        )
+
+@router.post("/batch")
+async def get_batch_recommendations(
+    request: BatchRecommendationsRequest,
+    user: dict = Depends(get_current_user)
+):
+    """
+    Top-N matches for many users in one pass (match digests, push notifications)
+    Internal endpoint: streams one JSON line per uid, {"uid", "matches"}, in request order;
+    uids whose regional model is still loading get an "error" instead (retry them)
+    """
+    if request.top_n < 1 or request.top_n > 50:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="top_n must be between 1 and 50"
+        )
+    if len(request.uids) > MAX_BATCH_UIDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {MAX_BATCH_UIDS} uids per request"
+        )
+    
+    # One group per model (regional mode: per region; partitions not loaded
+    # yet start loading now and their uids are answered with an error)
+    service = await resolve_regions(request.uids)
+    groups = service.group_by_model(request.uids)
+    if all(recommender is None for recommender, _ in groups):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Recommender is warming up, please retry shortly"
+        )
+    
+    # Model state is captured here, on the event loop where upserts are
+    # applied; scoring then runs in-process on the streaming thread
+    batches = [
+        (recommender.recommend_batch(uids, top_n=request.top_n) if recommender is not None else None, uids)
+        for recommender, uids in groups
+    ]
+    
+    warming = {uid for batch, uids in batches if batch is None for uid in uids}
+    
+    def results():
+        if len(batches) == 1:
+            yield from batches[0][0]
+            return
+        # Several models: collect, then emit in request order
+        by_uid = {}
+        for batch, uids in batches:
+            if batch is not None:
+                by_uid.update(batch)
+        for uid in request.uids:
+            yield uid, by_uid.get(uid, [])
+    
+    def stream():
+        # Sync generator: Starlette iterates it in a worker thread
+        for uid, records in results():
+            if uid in warming:
+                line = {"uid": uid, "matches": [], "error": "Recommender is warming up, please retry shortly"}
+            else:
+                line = {"uid": uid, "matches": [MatchRecommendation(**record).model_dump() for record in records]}
+            yield json.dumps(line) + "\n"
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@router.get("/ann/recall")
+async def get_ann_recall(
+    k: int = 10,
+    queries: int = 100,
+    user: dict = Depends(get_current_user)
+):
+    """
+    Measure recall@k and per-query latency of the ANN path against exact scoring
     Admin-only endpoint in production
     """
-    global _recommender, _last_profile_count
+    if k < 1 or k > 50 or queries < 1 or queries > 1000:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="k must be between 1 and 50 and queries between 1 and 1000"
+        )
     
     try:
-        profiles = get_all_user_profiles()
+        service = await get_service(user['uid'])
+        recommender = await get_recommender(user['uid'])
+        if recommender.ann_index is None:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="The serving model has no ANN index (RECOMMENDER_ANN is off)"
+            )
         
-        if not profiles:
+        # Hundreds of exact scans on a private copy of the model, off the event loop
+        loop = asyncio.get_running_loop()
+        report = await loop.run_in_executor(
+            None, lambda: service.measure_ann_recall(k, queries)
+        )
+        if report is None:
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="No user profiles found in database"
+                status_code=status.HTTP_409_CONFLICT,
+                detail="No published snapshot with an ANN index to measure"
             )
         
-        profiles_df = pd.DataFrame(profiles)
-        _recommender = HybridRecommender(profiles_df)
-        _recommender.fit()
-        _last_profile_count = len(profiles)
+        return {
+            "success": True,
+            **report
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to measure ANN recall: {str(e)}"
+        )
+
+@router.get("/memory")
+async def get_recommender_memory(user: dict = Depends(get_current_user)):
+    """
+    Bytes held by the caller's model, per component
+    Admin-only endpoint in production
+    """
+    try:
+        recommender = await get_recommender(user['uid'])
+        report = recommender.memory_report()
+        
+        return {
+            "success": True,
+            "compact": bool(recommender.compact_memory),
+            "users": len(recommender.uid_to_row),
+            "total_bytes": report.pop('total'),
+            "components": report
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to measure recommender memory: {str(e)}"
+        )
+
+@router.post("/refresh")
+async def refresh_recommender(user: dict = Depends(get_current_user)):
+    """
+    Force refresh the recommender model (useful after new users register)
+    In regional mode only the caller's region is refitted
+    Admin-only endpoint in production
+    """
+    try:
+        # Fit off the event loop; the new model is swapped in on the next request
+        loop = asyncio.get_running_loop()
+        recommender = await loop.run_in_executor(
+            None, lambda: get_recommender_service().service_for(user['uid']).rebuild(with_neighbor_table=True)
+        )
         
         return {
             "success": True,
-            "message": f"Recommender refreshed with {len(profiles)} profiles"
+            "message": f"Recommender refreshed with {len(recommender.uid_to_row)} profiles"
         }
         
     except Exception as e:
@@ -151,3 +387,41 @@ async def refresh_recommender(user: dict = Depends(get_current_user)):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to refresh recommender: {str(e)}"
         )
+
+@router.post("/neighbors/rebuild")
+async def rebuild_neighbor_table(
+    top_k: int = 50,
+    user: dict = Depends(get_current_user)
+):
+    """
+    Recompute the precomputed top-K neighbor table for the caller's model
+    /matches serves table rows directly and only rescores changed users
+    Admin-only endpoint in production
+    """
+    if top_k < 1 or top_k > 500:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="top_k must be between 1 and 500"
+        )
+    
+    try:
+        await get_recommender(user['uid'])
+        
+        # Built off the event loop on a copy of the model; swapped in on the next request
+        loop = asyncio.get_running_loop()
+        recommender = await loop.run_in_executor(
+            None, lambda: get_recommender_service().service_for(user['uid']).rebuild_neighbor_table(top_k)
+        )
+        
+        return {
+            "success": True,
+            "message": f"Neighbor table rebuilt for {recommender.feature_matrix.shape[0]} users (top {top_k})"
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to rebuild neighbor table: {str(e)}"
+        )
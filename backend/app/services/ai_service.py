@@ -6,11 +6,39 @@ import os
 from typing import Optional, Dict, List
 from openai import OpenAI
 from dotenv import load_dotenv
+from app.utils.tag_vocabulary import get_tag_vocabulary
 
 # Load environment variables
 load_dotenv()
 
 
+def profile_tag_ids(*profiles: Dict):
+    """
+    Tag ids of each profile's interest_tags, all in one vocabulary (the one
+    owning the first profile's ids), plus that vocabulary for labelling them.
+    Ids are read from the serving model's user store when it holds the user
+    """
+    # Recommender import is optional (sklearn may be unavailable), see main.py
+    try:
+        from app.services.recommender_service import get_recommender_service
+        service = get_recommender_service()
+    except Exception:
+        service = None
+
+    vocabulary = None
+    all_ids = []
+    for profile in profiles:
+        text = profile.get('interest_tags', '')
+        if service is not None:
+            ids, vocabulary = service.tag_ids(profile.get('uid'), text, vocabulary)
+        else:
+            if vocabulary is None:
+                vocabulary = get_tag_vocabulary()
+            ids = vocabulary.ids(text)
+        all_ids.append(ids)
+    return all_ids, vocabulary
+
+
 class AIService:
     """Service for AI/LLM operations"""
     
@@ -45,12 +73,10 @@ class AIService:
         sender_name = sender_profile.get('name', 'User')
         recipient_name = recipient_profile.get('name', 'the match')
         
-        # Get interests from interest_tags (comma-separated string)
-        recipient_interest_tags = recipient_profile.get('interest_tags', '')
-        recipient_interests = [tag.strip() for tag in recipient_interest_tags.split(',') if tag.strip()]
-        
-        sender_interest_tags = sender_profile.get('interest_tags', '')
-        sender_interests = [tag.strip() for tag in sender_interest_tags.split(',') if tag.strip()]
+        # Get interests from interest_tags as tag vocabulary ids
+        (recipient_ids, sender_ids), vocabulary = profile_tag_ids(recipient_profile, sender_profile)
+        recipient_interests = vocabulary.labels_of(recipient_ids)
+        sender_interests = vocabulary.labels_of(sender_ids)
         
         # Get other profile info
         recipient_location = recipient_profile.get('location', '')
@@ -61,7 +87,7 @@ class AIService:
         sender_interests_str = ', '.join(sender_interests) if sender_interests else 'various activities'
         
         # Common interests
-        common_interests = list(set(sender_interests) & set(recipient_interests))
+        common_interests = vocabulary.labels_of(vocabulary.common(sender_ids, recipient_ids))
         common_str = ', '.join(common_interests) if common_interests else None
         
         prompt = f"""You are a dating conversation expert helping {sender_name} start a conversation with {recipient_name}.
@@ -166,21 +192,17 @@ Generate ONLY the icebreaker message text (no quotes, no preamble, just the mess
         """
         recipient_name = recipient_profile.get('name', 'there')
         
-        # Parse interest tags
-        recipient_interest_tags = recipient_profile.get('interest_tags', '')
-        recipient_interests = [tag.strip() for tag in recipient_interest_tags.split(',') if tag.strip()]
-        
-        sender_interest_tags = sender_profile.get('interest_tags', '')
-        sender_interests = [tag.strip() for tag in sender_interest_tags.split(',') if tag.strip()]
+        # Interest tags as tag vocabulary ids
+        (recipient_ids, sender_ids), vocabulary = profile_tag_ids(recipient_profile, sender_profile)
         
         # Find common interests
-        common_interests = list(set(sender_interests) & set(recipient_interests))
+        common_ids = vocabulary.common(sender_ids, recipient_ids)
         
-        if common_interests:
-            interest = common_interests[0]
+        if len(common_ids):
+            interest = vocabulary.labels[common_ids[0]]
             return f"Hey {recipient_name}! I noticed we both enjoy {interest}. What got you into it?"
-        elif recipient_interests:
-            interest = recipient_interests[0]
+        elif len(recipient_ids):
+            interest = vocabulary.labels[recipient_ids[0]]
             return f"Hi {recipient_name}! I saw that you're into {interest}. I'd love to hear more about that!"
         else:
             return f"Hey {recipient_name}! Your profile caught my attention. What do you like to do for fun?"
@@ -0,0 +1,550 @@
+"""
+Recommender Service
+Owns the live HybridRecommender: snapshot attach, background rebuilds,
+the Firestore change feed and the atomic hot-swap between models.
+With RECOMMENDER_REGIONAL, one such service per location partition
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Optional, Dict, List
+
+from app.utils.profile import (
+    stream_profile_columns, get_profiles_changed_since, get_user_profiles, ProfileChangeFeed, utc_timestamp
+)
+from app.utils.profile_snapshot import load_profile_table, save_profile_table, apply_profile_changes
+from app.utils.recommend import HybridRecommender, FIT_FIELDS, NUMERIC_FIT_FIELDS
+from app.utils.ann_index import DEFAULT_ANN_CONFIG
+from app.utils.recommender_snapshot import build_lock, current_generation
+from app.utils.ranking_cache import RankingCache
+from app.utils.exclusions import ExclusionIndex, ExclusionFeed
+from app.utils.geo_index import resolve_region
+from app.utils.tag_vocabulary import TagVocabulary, get_tag_vocabulary
+
+
+# Optional dense scoring mode: dimension of the truncated-SVD embedding (0 = off)
+EMBEDDING_DIM = int(os.getenv("RECOMMENDER_EMBEDDING_DIM", "0")) or None
+
+# LSH index for /matches?ann=true, built with the model on the background
+# thread and saved in its snapshot (requests never build it)
+ANN = os.getenv("RECOMMENDER_ANN", "1").lower() in ("1", "true", "yes")
+# Its recall/speed trade-off (see app/utils/ann_index.py; measured by /ann/recall)
+ANN_CONFIG = {
+    **DEFAULT_ANN_CONFIG,
+    'n_tables': int(os.getenv("RECOMMENDER_ANN_TABLES", str(DEFAULT_ANN_CONFIG['n_tables']))),
+    'n_bits': int(os.getenv("RECOMMENDER_ANN_BITS", str(DEFAULT_ANN_CONFIG['n_bits']))),
+    'n_probes': int(os.getenv("RECOMMENDER_ANN_PROBES", str(DEFAULT_ANN_CONFIG['n_probes']))),
+}
+
+# Compact memory layout (float32 features, int32 indices, interned strings)
+COMPACT = os.getenv("RECOMMENDER_COMPACT", "0").lower() in ("1", "true", "yes")
+
+# Fitted models are snapshotted here so restarts skip the Firestore stream + fit
+SNAPSHOT_DIR = os.getenv(
+    "RECOMMENDER_SNAPSHOT_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "recommender_snapshot")
+)
+SNAPSHOT_MAX_AGE = int(os.getenv("RECOMMENDER_SNAPSHOT_MAX_AGE", str(24 * 3600)))
+
+# Local columnar copy of the profiles table (per model, next to its snapshots):
+# rebuilds fetch only profiles changed since it was written. Deleted profiles
+# are dropped by a full read once the last one is older than the max age.
+PROFILE_TABLE = os.getenv("RECOMMENDER_PROFILE_TABLE", "1").lower() in ("1", "true", "yes")
+PROFILE_TABLE_MAX_AGE = int(os.getenv("RECOMMENDER_PROFILE_TABLE_MAX_AGE", str(24 * 3600)))
+
+# How often the background thread checks for a newer published model
+SNAPSHOT_POLL_SECONDS = float(os.getenv("RECOMMENDER_SNAPSHOT_POLL_SECONDS", "1.0"))
+
+# Full refit interval (new vocabulary, compaction); 0 disables periodic rebuilds
+REBUILD_SECONDS = int(os.getenv("RECOMMENDER_REBUILD_SECONDS", str(6 * 3600)))
+
+# Per-user ranking cache behind /matches pagination
+CACHE_ENTRIES = int(os.getenv("RECOMMENDER_CACHE_ENTRIES", "5000"))
+CACHE_TTL_SECONDS = int(os.getenv("RECOMMENDER_CACHE_TTL_SECONDS", "600"))
+CACHE_DEPTH = int(os.getenv("RECOMMENDER_CACHE_DEPTH", "500"))
+# Candidates ranked for a user's first page; kept below the neighbor table's
+# K (50) so the table still serves it after a few entries are filtered out
+CACHE_CHUNK = int(os.getenv("RECOMMENDER_CACHE_CHUNK", "40"))
+
+# One model per region (state of the profile's city) instead of one global
+# model; users whose location cannot be resolved share the fallback model
+REGIONAL = os.getenv("RECOMMENDER_REGIONAL", "0").lower() in ("1", "true", "yes")
+FALLBACK_REGION = "global"
+
+
+def _parse_timestamp(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def profile_region(profile) -> str:
+    """Partition a profile belongs to in regional mode"""
+    return resolve_region(profile.get('location')) or FALLBACK_REGION
+
+
+class RecommenderService:
+    """
+    Serves one recommender per worker process
+
+    Request handlers only ever call get_recommender(): it swaps in a model
+    finished by the background thread and applies buffered profile changes
+    (O(changes)), then returns. The full `profiles` collection is read and
+    models are fitted only on the background thread, never on the event loop.
+    """
+
+    def __init__(self, region: Optional[str] = None, exclusions: Optional[ExclusionIndex] = None):
+        # Partition served (None = every user) and where its snapshots live
+        self.region = region
+        self.snapshot_dir = SNAPSHOT_DIR if region is None else os.path.join(SNAPSHOT_DIR, "regions", region)
+
+        self.recommender = None        # serving model, touched only by the event loop
+        self._next = None              # model built/attached in the background, swapped in on next request
+        self._next_lock = threading.Lock()
+        self._build_lock = threading.Lock()
+
+        self._change_feed = ProfileChangeFeed()
+        self._change_log = {}          # uid -> (changed_at, profile or None), replayed onto swapped-in models
+
+        # Ranked lists served by /matches pages; cleared on swap, per user on profile change
+        self.ranking_cache = RankingCache(CACHE_ENTRIES, CACHE_TTL_SECONDS, CACHE_DEPTH, CACHE_CHUNK)
+
+        # Already-messaged / skipped users, shared by every model this service serves.
+        # A shared index passed in is fed by its owner (RegionalRecommenderService)
+        if exclusions is None:
+            self.exclusions = ExclusionIndex()
+            self._exclusion_feed = ExclusionFeed(
+                self.exclusions, on_change=self.ranking_cache.invalidate_user, on_reload=self.ranking_cache.clear
+            )
+        else:
+            self.exclusions = exclusions
+            self._exclusion_feed = None
+
+        self._thread = None
+        self._stop = threading.Event()
+
+    # ------------------------------------------------------------------
+    # Request path (event loop)
+    # ------------------------------------------------------------------
+    def start(self):
+        """Start the background refresher thread (idempotent)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="recommender-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._change_feed.stop()
+        if self._exclusion_feed is not None:
+            self._exclusion_feed.stop()
+
+    def service_for(self, uid: str) -> "RecommenderService":
+        """The service whose model serves uid (this one; see RegionalRecommenderService)"""
+        return self
+
+    def missing_regions(self, uids: List[str]) -> List[str]:
+        """Uids whose partition is not known without a Firestore read (none: one model)"""
+        return []
+
+    def resolve_regions(self, uids: List[str]):
+        pass
+
+    def group_by_model(self, uids: List[str]):
+        """(model, uids) pairs covering uids; one pair, model None while warming up"""
+        return [(self.get_recommender(), list(uids))]
+
+    def tag_ids(self, uid: Optional[str], interest_tags, vocabulary: Optional[TagVocabulary] = None):
+        """
+        (ids, vocabulary owning them) for a profile's interest_tags: the
+        model's stored row when it holds uid with these same tags, parsed
+        otherwise. Given a vocabulary, the ids are always in that one
+        (to compare them with ids issued by another model)
+        """
+        recommender = self.recommender
+        if recommender is not None:
+            if vocabulary is None:
+                vocabulary = recommender.tag_vocabulary
+            if vocabulary is recommender.tag_vocabulary and uid is not None:
+                row = recommender.uid_to_row.get(uid)
+                if row is not None and recommender.store.columns['interest_tags'][row] == interest_tags:
+                    return recommender.store.tag_ids(row), vocabulary
+        if vocabulary is None:
+            vocabulary = get_tag_vocabulary()
+        return vocabulary.ids(interest_tags), vocabulary
+
+    def _in_partition(self, profile: Dict) -> bool:
+        return self.region is None or profile_region(profile) == self.region
+
+    def get_recommender(self) -> Optional[HybridRecommender]:
+        """Current model, or None while the first one is still loading"""
+        self._swap_in_next()
+        if self.recommender is None:
+            self.start()
+            return None
+        self._apply_changes(self._change_feed.drain())
+        return self.recommender
+
+    def _swap_in_next(self):
+        with self._next_lock:
+            recommender, self._next = self._next, None
+        if recommender is None:
+            return
+
+        # Replay changes the new model's data predates
+        watermark = recommender.watermark
+        replay = {
+            uid: entry for uid, entry in self._change_log.items()
+            if watermark is None or entry[0] > watermark
+        }
+        self.recommender = recommender
+        self.ranking_cache.clear()
+        self._change_log = {}
+        self._apply_changes(replay)
+        print(f"Recommender swapped in (generation {recommender.generation}, "
+              f"{len(replay)} changes replayed)")
+
+    def _apply_changes(self, changes: Dict):
+        for uid, (changed_at, profile) in changes.items():
+            self._change_log[uid] = (changed_at, profile)
+            self.ranking_cache.invalidate_user(uid)
+            try:
+                if profile is None or not self._in_partition(profile):
+                    # Deleted, or moved to another region's model
+                    self.recommender.remove_user(uid)
+                else:
+                    self.recommender.upsert_user({**profile, 'uid': uid})
+            except Exception as e:
+                print(f"Error applying profile change for {uid}: {str(e)}")
+
+    def update_profile(self, uid: str, profile: Dict):
+        """Apply one edited profile right away (the change feed will confirm it)"""
+        if self.recommender is None or not profile:
+            return
+        self._apply_changes({uid: (profile.get('updatedAt') or utc_timestamp(), profile)})
+
+    def skip(self, uid: str, skipped_uid: str):
+        """Exclude one user from uid's recommendations right away (the skips feed confirms it)"""
+        self.exclusions.add(uid, [skipped_uid])
+        self.ranking_cache.invalidate_user(uid)
+
+    # ------------------------------------------------------------------
+    # Building and publishing (background thread / executor)
+    # ------------------------------------------------------------------
+    def _offer(self, recommender):
+        recommender.attach_exclusions(self.exclusions)
+        with self._next_lock:
+            self._next = recommender
+
+    def _load_snapshot(self, max_age_seconds=SNAPSHOT_MAX_AGE):
+        try:
+            return HybridRecommender.load(self.snapshot_dir, max_age_seconds=max_age_seconds)
+        except Exception as e:
+            print(f"⚠️  Warning: Could not load recommender snapshot: {e}")
+            return None
+
+    def _save_snapshot(self, recommender):
+        try:
+            recommender.save(self.snapshot_dir)
+        except Exception as e:
+            print(f"⚠️  Warning: Could not save recommender snapshot: {e}")
+
+    def _read_profiles(self, watermark):
+        """
+        Profile columns of this model: the local profile table plus the
+        profiles changed since its watermark, or a full streamed read
+        """
+        table_dir = os.path.join(self.snapshot_dir, "profiles")
+        loaded = None
+        if PROFILE_TABLE:
+            try:
+                loaded = load_profile_table(table_dir, FIT_FIELDS, NUMERIC_FIT_FIELDS, PROFILE_TABLE_MAX_AGE)
+            except Exception as e:
+                print(f"⚠️  Warning: Could not load profile table: {e}")
+
+        if loaded is not None:
+            profiles, manifest = loaded
+            full_read_at = manifest['full_read_at']
+            changed = get_profiles_changed_since(manifest['watermark'], FIT_FIELDS)
+            upserted, removed = apply_profile_changes(profiles, changed, keep=self._in_partition)
+            print(f"Profile table: {upserted} changed, {removed} moved out since {manifest['watermark']}")
+        else:
+            full_read_at = time.time()
+            # Streamed straight into columns: only the fields the model reads, one page at a time
+            profiles = stream_profile_columns(FIT_FIELDS, numeric=NUMERIC_FIT_FIELDS, keep=self._in_partition)
+
+        if PROFILE_TABLE:
+            try:
+                save_profile_table(profiles, table_dir, watermark, full_read_at)
+            except Exception as e:
+                print(f"⚠️  Warning: Could not save profile table: {e}")
+        return profiles
+
+    def _fit_from_firestore(self):
+        watermark = utc_timestamp()      # taken before the read: later edits get replayed
+        profiles = self._read_profiles(watermark)
+        if not profiles.n_rows:
+            raise RuntimeError("No user profiles found in database")
+
+        label = f" for region {self.region}" if self.region else ""
+        print(f"Fitting recommender{label} on {profiles.n_rows} profiles...")
+        recommender = HybridRecommender(
+            profiles.to_frame(),
+            ann_config=ANN_CONFIG if ANN else None,
+            embedding_dim=EMBEDDING_DIM,
+            compact=COMPACT
+        )
+        recommender.fit()
+        recommender.watermark = watermark
+        return recommender
+
+    def rebuild(self, with_neighbor_table=True, only_if_older_than=None) -> HybridRecommender:
+        """
+        Fit from Firestore, publish a snapshot and queue the model for the swap
+
+        Holds the cross-process build lock. With only_if_older_than, a model
+        another worker published while we waited for the lock is attached
+        instead of fitting again.
+        """
+        with self._build_lock, build_lock(self.snapshot_dir):
+            if only_if_older_than is not None:
+                published = self._load_snapshot(max_age_seconds=only_if_older_than)
+                if published is not None:
+                    self._offer(published)
+                    return published
+
+            recommender = self._fit_from_firestore()
+            if with_neighbor_table:
+                # In-process: forking a worker with live Firestore gRPC threads can hang the child
+                recommender.build_neighbor_table(n_jobs=1)
+            self._save_snapshot(recommender)
+            # Re-attach through the mmap so this worker shares pages with the rest
+            recommender = self._load_snapshot(None) or recommender
+
+        self._offer(recommender)
+        print("Recommender rebuilt successfully")
+        return recommender
+
+    def rebuild_neighbor_table(self, top_k: int) -> HybridRecommender:
+        """
+        Recompute the neighbor table on a private copy of the published
+        model, publish it and queue it for the swap (changes since its
+        watermark are replayed then, as for any rebuild). The serving model
+        is never touched, so requests keep being answered meanwhile.
+        """
+        with self._build_lock, build_lock(self.snapshot_dir):
+            recommender = self._load_snapshot(None) or self._fit_from_firestore()
+            recommender.build_neighbor_table(top_k=top_k, n_jobs=1)
+            self._save_snapshot(recommender)
+            recommender = self._load_snapshot(None) or recommender
+
+        self._offer(recommender)
+        return recommender
+
+    def measure_ann_recall(self, k: int, n_queries: int) -> Optional[Dict]:
+        """
+        recall@k of the ANN path, measured on a private copy of the published
+        model (blocking; run it in an executor). The serving model keeps
+        taking profile changes meanwhile, and a compaction would renumber
+        its rows mid-measurement. None when no published model has an index.
+        """
+        recommender = self._load_snapshot(None)
+        if recommender is None or recommender.ann_index is None:
+            return None
+        report = recommender.measure_ann_recall(k=k, n_queries=n_queries)
+        report['generation'] = recommender.generation
+        return report
+
+    # ------------------------------------------------------------------
+    # Background refresher
+    # ------------------------------------------------------------------
+    def _latest(self):
+        with self._next_lock:
+            return self._next or self.recommender
+
+    def _attach_published_model(self):
+        """Queue a model another worker published (generation changed)"""
+        latest = self._latest()
+        generation = current_generation(self.snapshot_dir)
+        if generation == 0 or (latest is not None and generation == latest.generation):
+            return
+        # A freshly published generation is never stale; only a cold start applies the max age
+        recommender = self._load_snapshot(SNAPSHOT_MAX_AGE if latest is None else None)
+        if recommender is not None:
+            self._offer(recommender)
+            print(f"Recommender attached to snapshot generation {generation}")
+
+    def _rebuild_due(self, recommender):
+        if not REBUILD_SECONDS or recommender.watermark is None:
+            return False
+        age = time.time() - _parse_timestamp(recommender.watermark).timestamp()
+        return age > REBUILD_SECONDS
+
+    def _ensure_change_feed(self, recommender):
+        """
+        Watch changes after the newest model's watermark. Restarted for each
+        new model: a feed left on an older watermark would keep growing
+        towards the whole collection. Buffered changes survive the restart.
+        """
+        since = recommender.watermark
+        if self._change_feed.running and (since is None or since == self._change_feed.since):
+            return
+        try:
+            self._change_feed.stop()
+            self._change_feed.start(since=since or utc_timestamp())
+        except Exception as e:
+            print(f"⚠️  Warning: Could not start profile change feed: {e}")
+
+    def _ensure_exclusion_feed(self):
+        if self._exclusion_feed is None or self._exclusion_feed.running:
+            return
+        try:
+            self._exclusion_feed.start()
+        except Exception as e:
+            print(f"⚠️  Warning: Could not start exclusion feed: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._ensure_exclusion_feed()
+                self._attach_published_model()
+                latest = self._latest()
+                if latest is None:
+                    self.rebuild(with_neighbor_table=False, only_if_older_than=SNAPSHOT_MAX_AGE)
+                elif self._rebuild_due(latest):
+                    self.rebuild(only_if_older_than=REBUILD_SECONDS)
+                latest = self._latest()
+                if latest is not None:
+                    self._ensure_change_feed(latest)
+            except Exception as e:
+                print(f"Error in recommender refresher: {str(e)}")
+                self._stop.wait(30)
+            self._stop.wait(SNAPSHOT_POLL_SECONDS)
+
+
+class RegionalRecommenderService:
+    """
+    One RecommenderService per region, created (and its model loaded or
+    fitted) the first time a user from that region asks for matches or is
+    part of a batch
+
+    Each partition refits, snapshots and follows profile changes on its own,
+    so refit cost and memory scale with the region. Exclusions are one
+    shared index fed here, since conversations cross regions.
+    """
+
+    def __init__(self):
+        self.partitions: Dict[str, RecommenderService] = {}
+        self._partitions_lock = threading.Lock()
+        self._user_regions = {}        # uid -> region, for users not in a loaded model
+
+        self.exclusions = ExclusionIndex()
+        self._exclusion_feed = ExclusionFeed(
+            self.exclusions, on_change=self._invalidate_user, on_reload=self._clear_caches
+        )
+
+    def start(self):
+        """Start the exclusion feed; partitions start on first use"""
+        if not self._exclusion_feed.running:
+            try:
+                self._exclusion_feed.start()
+            except Exception as e:
+                print(f"⚠️  Warning: Could not start exclusion feed: {e}")
+
+    def stop(self):
+        self._exclusion_feed.stop()
+        for service in list(self.partitions.values()):
+            service.stop()
+
+    def partition(self, region: str) -> RecommenderService:
+        """The region's service, started on first use"""
+        service = self.partitions.get(region)
+        if service is None:
+            with self._partitions_lock:
+                service = self.partitions.get(region)
+                if service is None:
+                    print(f"Loading recommender partition {region}")
+                    service = RecommenderService(region=region, exclusions=self.exclusions)
+                    self.partitions[region] = service
+            service.start()
+        return service
+
+    def _cached_region(self, uid: str) -> Optional[str]:
+        # Loaded models are kept current by their change feeds
+        for region, service in list(self.partitions.items()):
+            recommender = service.recommender
+            if recommender is not None and uid in recommender.uid_to_row:
+                return region
+        return self._user_regions.get(uid)
+
+    def missing_regions(self, uids: List[str]) -> List[str]:
+        """Uids whose region needs a Firestore read (resolve_regions(), off the event loop)"""
+        return [uid for uid in uids if self._cached_region(uid) is None]
+
+    def resolve_regions(self, uids: List[str]):
+        """Read the location of users in no loaded model, in batched gets; blocking"""
+        profiles = get_user_profiles(uids, fields=['location'])
+        for uid, profile in profiles.items():
+            self._user_regions[uid] = profile_region(profile) if profile else FALLBACK_REGION
+
+    def _region_of(self, uid: str) -> str:
+        region = self._cached_region(uid)
+        if region is None:
+            self.resolve_regions([uid])
+            region = self._user_regions[uid]
+        return region
+
+    def service_for(self, uid: str) -> RecommenderService:
+        return self.partition(self._region_of(uid))
+
+    def group_by_model(self, uids: List[str]):
+        """
+        (model, uids) pairs covering uids, one per region. Partitions not
+        loaded yet are started and paired with None (still warming up).
+        Call resolve_regions(missing_regions(uids)) first, off the event loop.
+        """
+        groups = {}
+        for uid in uids:
+            groups.setdefault(self._region_of(uid), []).append(uid)
+        return [(self.partition(region).get_recommender(), group) for region, group in groups.items()]
+
+    def tag_ids(self, uid: Optional[str], interest_tags, vocabulary: Optional[TagVocabulary] = None):
+        """RecommenderService.tag_ids() of the loaded partition holding uid"""
+        region = self._cached_region(uid) if uid is not None else None
+        service = self.partitions.get(region) if region is not None else None
+        if service is None:
+            if vocabulary is None:
+                vocabulary = get_tag_vocabulary()
+            return vocabulary.ids(interest_tags), vocabulary
+        return service.tag_ids(uid, interest_tags, vocabulary)
+
+    def update_profile(self, uid: str, profile: Dict):
+        """Every loaded partition applies it: the user's region upserts, the others drop the uid"""
+        if not profile:
+            return
+        self._user_regions[uid] = profile_region(profile)
+        for service in list(self.partitions.values()):
+            service.update_profile(uid, profile)
+
+    def skip(self, uid: str, skipped_uid: str):
+        self.exclusions.add(uid, [skipped_uid])
+        self._invalidate_user(uid)
+
+    def _invalidate_user(self, uid: str):
+        for service in list(self.partitions.values()):
+            service.ranking_cache.invalidate_user(uid)
+
+    def _clear_caches(self):
+        for service in list(self.partitions.values()):
+            service.ranking_cache.clear()
+
+
+# Singleton instance
+_recommender_service = None
+
+def get_recommender_service():
+    """Get or create the RecommenderService (or RegionalRecommenderService) singleton"""
+    global _recommender_service
+    if _recommender_service is None:
+        _recommender_service = RegionalRecommenderService() if REGIONAL else RecommenderService()
+    return _recommender_service
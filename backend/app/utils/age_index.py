@@ -0,0 +1,61 @@
+"""
+Age-sorted row index for age-range queries
+
+Rows with a known age are kept as one row-id array sorted by age, so the
+rows inside [min_age, max_age] are a single binary-searched slice. Rows
+whose age changed (or that were appended) after fit() are kept in
+``pending_rows`` and checked directly, the same scheme as the LSH and geo
+indexes; entries left stale by an edit are dropped by re-checking the
+current ages of the slice.
+"""
+import numpy as np
+
+
+class SortedAgeIndex:
+    """Row ids ordered by age"""
+
+    def __init__(self):
+        self.sorted_ages = np.empty(0, dtype=np.float32)
+        self.sorted_rows = np.empty(0, dtype=np.int32)
+        self.pending_rows = []
+
+    def fit(self, ages):
+        known = np.flatnonzero(~np.isnan(ages))
+        order = np.argsort(ages[known], kind='stable')
+        self.sorted_rows = known[order].astype(np.int32)
+        self.sorted_ages = ages[self.sorted_rows]
+        self.pending_rows = []
+        return self
+
+    def add(self, row):
+        """Register a row whose age was set or changed after fit()"""
+        self.pending_rows.append(row)
+
+    def _bounds(self, min_age, max_age):
+        lo = 0 if min_age is None else np.searchsorted(self.sorted_ages, min_age, side='left')
+        hi = len(self.sorted_ages) if max_age is None else np.searchsorted(self.sorted_ages, max_age, side='right')
+        return lo, hi
+
+    def count(self, min_age, max_age):
+        """Rows in range as of fit() (pending rows not counted); for planning"""
+        lo, hi = self._bounds(min_age, max_age)
+        return hi - lo
+
+    def query(self, min_age, max_age, ages):
+        """Sorted row ids with min_age <= age <= max_age (either bound may be None)"""
+        lo, hi = self._bounds(min_age, max_age)
+        rows = self.sorted_rows[lo:hi]
+        if not self.pending_rows:
+            return np.sort(rows)
+
+        rows = np.unique(np.concatenate([rows, np.asarray(self.pending_rows, dtype=np.int32)]))
+        current = ages[rows]
+        keep = ~np.isnan(current)
+        if min_age is not None:
+            keep &= current >= min_age
+        if max_age is not None:
+            keep &= current <= max_age
+        return rows[keep]
+
+    def nbytes(self):
+        return self.sorted_ages.nbytes + self.sorted_rows.nbytes
@@ -0,0 +1,101 @@
+"""
+Approximate nearest-neighbor index for the recommender (random-hyperplane LSH)
+
+Each of ``n_tables`` tables hashes a row to an ``n_bits`` signature (the
+signs of its dot products with random hyperplanes), so rows with a small
+cosine angle tend to share a bucket. Buckets are stored as one sorted code
+array per table, so a lookup is a binary search rather than a dict of lists.
+
+Recall is tuned with:
+    n_tables: more tables -> higher recall, more candidates
+    n_bits:   more bits -> smaller buckets, lower recall, fewer candidates
+    n_probes: 0 = exact bucket only, 1 = also every bucket one bit away
+"""
+import numpy as np
+
+
+DEFAULT_ANN_CONFIG = {
+    'n_tables': 8,
+    'n_bits': 12,
+    'n_probes': 1,
+    'seed': 0,
+}
+
+# Rows hashed per block while building (bounds the dense projection buffer)
+BUILD_BLOCK_ROWS = 65536
+
+
+class LSHIndex:
+    """Random-hyperplane LSH over the rows of a sparse feature matrix"""
+
+    def __init__(self, n_tables=8, n_bits=12, n_probes=1, seed=0):
+        if not 1 <= n_bits <= 31:
+            raise ValueError("n_bits must be between 1 and 31")
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.n_probes = n_probes
+        self.seed = seed
+
+        self.hyperplanes = None     # (n_features, n_tables * n_bits) float32
+        self.sorted_codes = []      # per table: uint32 codes, ascending
+        self.sorted_rows = []       # per table: int32 row ids in code order
+        self.pending_rows = []      # rows added/changed since build, checked directly
+        self._bit_weights = (1 << np.arange(n_bits, dtype=np.uint32)).astype(np.uint32)
+
+    def _codes(self, X):
+        """(n_rows, n_tables) uint32 signatures for a block of rows"""
+        bits = np.asarray(X @ self.hyperplanes) > 0
+        bits = bits.reshape(X.shape[0], self.n_tables, self.n_bits)
+        return (bits * self._bit_weights).sum(axis=2, dtype=np.uint32)
+
+    def fit(self, X):
+        rng = np.random.default_rng(self.seed)
+        self.hyperplanes = rng.standard_normal(
+            (X.shape[1], self.n_tables * self.n_bits)
+        ).astype(np.float32)
+
+        codes = np.empty((X.shape[0], self.n_tables), dtype=np.uint32)
+        for start in range(0, X.shape[0], BUILD_BLOCK_ROWS):
+            end = min(start + BUILD_BLOCK_ROWS, X.shape[0])
+            codes[start:end] = self._codes(X[start:end])
+
+        self.sorted_codes, self.sorted_rows = [], []
+        for t in range(self.n_tables):
+            order = np.argsort(codes[:, t], kind='stable')
+            self.sorted_codes.append(codes[order, t])
+            self.sorted_rows.append(order.astype(np.int32))
+        self.pending_rows = []
+        return self
+
+    def add(self, row):
+        """
+        Register a row that was appended or re-encoded after fit(). It is
+        returned as a candidate for every query until the next fit().
+        """
+        self.pending_rows.append(row)
+
+    def _probe_codes(self, code):
+        if self.n_probes <= 0:
+            return np.array([code], dtype=np.uint32)
+        flips = np.uint32(code) ^ self._bit_weights
+        return np.concatenate([np.array([code], dtype=np.uint32), flips])
+
+    def query(self, query_vec):
+        """Candidate row ids (unique, unsorted) for one query row"""
+        codes = self._codes(query_vec)[0]
+        found = []
+        for t in range(self.n_tables):
+            probes = self._probe_codes(codes[t])
+            lo = np.searchsorted(self.sorted_codes[t], probes, side='left')
+            hi = np.searchsorted(self.sorted_codes[t], probes, side='right')
+            found.extend(self.sorted_rows[t][a:b] for a, b in zip(lo, hi) if b > a)
+        if self.pending_rows:
+            found.append(np.asarray(self.pending_rows, dtype=np.int32))
+        if not found:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(found))
+
+    def nbytes(self):
+        return (self.hyperplanes.nbytes
+                + sum(c.nbytes for c in self.sorted_codes)
+                + sum(r.nbytes for r in self.sorted_rows))
@@ -0,0 +1,241 @@
+"""
+Recommender benchmark on synthetic populations (no Firestore needed)
+
+For every population size this reports fit wall time, peak RSS, feature
+matrix size, the model's per-component memory report and p50/p95/p99 latency of single-user recommend() and of
+recommend_batch(), and writes everything to one JSON file so results can be
+compared between releases.
+
+Each size runs in a fresh process, so peak RSS is that size's own peak.
+
+Usage (from backend/):
+    python -m app.utils.benchmark
+    python -m app.utils.benchmark --sizes 1000,10000,100000,1000000 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+# Value sets of the dataset process.py reads (dating.csv) / the Register form
+GENDERS = ['Male', 'Female', 'Non-binary', 'Genderfluid', 'Transgender', 'Prefer Not to Say']
+GENDER_WEIGHTS = [0.42, 0.42, 0.05, 0.03, 0.04, 0.04]
+ORIENTATIONS = ['Straight', 'Gay', 'Lesbian', 'Bisexual', 'Pansexual', 'Queer', 'Asexual', 'Demisexual']
+ORIENTATION_WEIGHTS = [0.62, 0.08, 0.06, 0.12, 0.04, 0.04, 0.02, 0.02]
+INCOME_BRACKETS = ['Very Low', 'Low', 'Lower-Middle', 'Middle', 'Upper-Middle', 'High', 'Very High']
+EDUCATION_LEVELS = ['No Formal Education', 'High School', 'Diploma', "Associate's",
+                    "Bachelor's", "Master's", 'MBA', 'PhD', 'Postdoc']
+INTEREST_TAGS = ['hiking', 'music', 'travel', 'cooking', 'gaming', 'reading', 'yoga', 'art',
+                 'movies', 'coffee', 'dogs', 'cats', 'tech', 'fitness', 'photography', 'dancing',
+                 'wine', 'fashion', 'sports', 'anime', 'podcasts', 'gardening', 'cycling', 'running',
+                 'writing', 'volunteering', 'board games', 'theater', 'startups', 'meditation']
+CITIES = ['New York', 'Los Angeles', 'Chicago', 'Houston', 'Phoenix', 'Philadelphia', 'San Antonio',
+          'San Diego', 'Dallas', 'Austin', 'Seattle', 'Denver', 'Boston', 'Miami', 'Atlanta',
+          'Portland', 'Nashville', 'Minneapolis']
+
+
+def _numbered(prefix, ids, suffix=''):
+    """prefix + str(id) + suffix for every id, as an object array"""
+    return np.char.add(np.char.add(prefix, ids.astype(str)), suffix).astype(object)
+
+
+def synthetic_profiles(n, seed=0, start=0, rng=None):
+    """
+    n profiles with the fields process.py produces (plus location), as a
+    DataFrame. About 10% of users live in towns the centroid table does not
+    know, like faker's city names.
+
+    Users are numbered from start; rng defaults to default_rng(seed).
+    Every field is sampled column-wise, with no per-row Python.
+    """
+    rng = rng if rng is not None else np.random.default_rng(seed)
+
+    # Interest tags: 0-5 distinct tags per user, popular tags more likely
+    tag_weights = 1.0 / np.arange(1, len(INTEREST_TAGS) + 1)
+    tag_keys = rng.random((n, len(INTEREST_TAGS))) ** (1.0 / tag_weights)
+    top_tags = np.argsort(-tag_keys, axis=1)[:, :5]
+    n_tags = rng.integers(0, 6, n)
+    tags = np.array(INTEREST_TAGS, dtype=object)
+    interest_tags = np.where(n_tags > 0, tags[top_tags[:, 0]], '').astype(object)
+    for k in range(1, top_tags.shape[1]):
+        interest_tags = np.where(n_tags > k, interest_tags + ', ' + tags[top_tags[:, k]], interest_tags)
+
+    city_weights = 1.0 / np.arange(1, len(CITIES) + 1)
+    locations = np.array(CITIES, dtype=object)[
+        rng.choice(len(CITIES), n, p=city_weights / city_weights.sum())
+    ]
+    unknown = rng.random(n) < 0.1
+    locations[unknown] = _numbered("Town ", rng.integers(0, 1000, unknown.sum()))
+
+    usage_min = rng.gamma(2.0, 45.0, n).astype(int)
+    ids = np.arange(start, start + n)
+
+    return pd.DataFrame({
+        'uid': _numbered(f"user-{seed}-", ids),
+        'name': _numbered("User ", ids),
+        'email': _numbered("user", ids, "@example.com"),
+        'age': rng.integers(16, 49, n),     # 16-48 inclusive, as process.py fills missing ages
+        'location': locations,
+        'gender': rng.choice(GENDERS, n, p=GENDER_WEIGHTS),
+        'sexual_orientation': rng.choice(ORIENTATIONS, n, p=ORIENTATION_WEIGHTS),
+        'income_bracket': rng.choice(INCOME_BRACKETS, n),
+        'education_level': rng.choice(EDUCATION_LEVELS, n),
+        'interest_tags': interest_tags,
+        'likes_received': rng.poisson(40, n),
+        'mutual_matches': rng.poisson(6, n),
+        'app_usage_time_label': np.where(usage_min < 60, 'Low', np.where(usage_min < 180, 'Moderate', 'High')),
+        'app_usage_time_min': usage_min,
+    })
+
+
+def _percentiles_ms(seconds):
+    ms = 1000 * np.asarray(seconds)
+    return {
+        'p50': round(float(np.percentile(ms, 50)), 3),
+        'p95': round(float(np.percentile(ms, 95)), 3),
+        'p99': round(float(np.percentile(ms, 99)), 3),
+        'mean': round(float(ms.mean()), 3),
+    }
+
+
+def _peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_size(n_users, n_queries=200, batch_size=256, n_batches=5, top_n=10, seed=0, compact=False):
+    """Benchmark one population size in the current process"""
+    import contextlib
+    import io
+    from app.utils.recommend import HybridRecommender
+
+    rss_start = _peak_rss_mb()
+    df = synthetic_profiles(n_users, seed=seed)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        recommender = HybridRecommender(df, compact=compact)
+        recommender.fit()
+    fit_seconds = time.perf_counter() - start
+    del df
+
+    X = recommender.feature_matrix
+    rng = np.random.default_rng(seed + 1)
+    uids = np.array(recommender.user_ids, dtype=object)
+
+    single = []
+    for uid in rng.choice(uids, n_queries):
+        start = time.perf_counter()
+        recommender.recommend(uid, top_n=top_n)
+        single.append(time.perf_counter() - start)
+
+    batch = []
+    for _ in range(n_batches):
+        query_uids = rng.choice(uids, min(batch_size, n_users), replace=False)
+        start = time.perf_counter()
+        for _ in recommender.recommend_batch(query_uids, top_n=top_n):
+            pass
+        batch.append(time.perf_counter() - start)
+
+    return {
+        'n_users': n_users,
+        'fit_seconds': round(fit_seconds, 3),
+        'peak_rss_mb': _peak_rss_mb(),
+        'start_rss_mb': rss_start,
+        'matrix': {
+            'rows': X.shape[0],
+            'features': X.shape[1],
+            'nnz': int(X.nnz),
+            'bytes': int(X.data.nbytes + X.indices.nbytes + X.indptr.nbytes),
+        },
+        'compact': compact,
+        'memory_bytes': recommender.memory_report(),
+        'single_query_ms': _percentiles_ms(single),
+        'batch_ms': {
+            'batch_size': min(batch_size, n_users),
+            **_percentiles_ms(batch),
+            'users_per_second': round(len(batch) * min(batch_size, n_users) / sum(batch), 1),
+        },
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(sizes=DEFAULT_SIZES, output=None, **params):
+    """Run every size in its own process; returns (and optionally writes) the report"""
+    import scipy
+    import sklearn
+
+    results = []
+    for n_users in sizes:
+        print(f"Benchmarking {n_users} users...")
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+            result = pool.submit(run_size, n_users, **params).result()
+        print(f"   -> fit {result['fit_seconds']}s, peak RSS {result['peak_rss_mb']} MB, "
+              f"single p50 {result['single_query_ms']['p50']} ms, "
+              f"batch {result['batch_ms']['users_per_second']} users/s")
+        results.append(result)
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'git_commit': _git_commit(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'scikit_learn': sklearn.__version__,
+        },
+        'params': params,
+        'results': results,
+    }
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Benchmark results written to {output}")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark HybridRecommender on synthetic users")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated population sizes")
+    parser.add_argument('--queries', type=int, default=200, help="single-user queries per size")
+    parser.add_argument('--batch-size', type=int, default=256, help="uids per recommend_batch call")
+    parser.add_argument('--batches', type=int, default=5, help="recommend_batch calls per size")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compact', action='store_true', help="fit in the compact memory layout")
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    run_benchmark(
+        sizes=[int(size) for size in args.sizes.split(',')],
+        output=args.output,
+        n_queries=args.queries,
+        batch_size=args.batch_size,
+        n_batches=args.batches,
+        seed=args.seed,
+        compact=args.compact,
+    )
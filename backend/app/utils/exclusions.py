@@ -0,0 +1,225 @@
+"""
+Per-user exclusion sets for the recommender (already messaged / skipped)
+
+Every uid is interned to a small stable integer key, and each user's
+exclusions are a ``KeyBitmap`` over those keys: a sorted int32 array while
+sparse, switching to a packed bitmap once that is smaller (the roaring
+array/bitmap container rule). The recommender keeps a row -> key array, so
+excluding candidates is one vectorized gather + test before top-k, however
+many people a user has excluded. Keys (not row ids) are stored so edits
+that move a user to a new row, compaction and model swaps never lose an
+exclusion.
+
+Sources, kept current by ``ExclusionFeed`` snapshot listeners:
+    conversations/{uidA_uidB}   participants: [uidA, uidB] - excluded both ways
+    skips/{uid}_{skipped_uid}   uid, skipped_uid - excluded for uid only
+"""
+import threading
+
+import numpy as np
+
+from app.utils.auth import get_firestore_client
+
+
+class KeyBitmap:
+    """Set of non-negative int keys: sorted array while sparse, packed bits once dense"""
+
+    def __init__(self):
+        self._array = np.empty(0, dtype=np.int32)
+        self._bits = None
+
+    def __len__(self):
+        if self._bits is None:
+            return len(self._array)
+        return int(np.unpackbits(self._bits).sum())
+
+    @property
+    def nbytes(self):
+        return self._bits.nbytes if self._bits is not None else self._array.nbytes
+
+    def add(self, keys):
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(keys) == 0:
+            return
+        if self._bits is None:
+            self._array = np.union1d(self._array, keys).astype(np.int32)
+            # 4 bytes per array entry vs 1 bit per key up to the largest one
+            if 4 * len(self._array) > (int(self._array[-1]) + 8) // 8:
+                self._to_bits()
+            return
+        self._grow_bits(int(keys.max()))
+        np.bitwise_or.at(self._bits, keys >> 3, (1 << (keys & 7)).astype(np.uint8))
+
+    def _grow_bits(self, max_key):
+        needed = max_key // 8 + 1
+        if len(self._bits) < needed:
+            grown = np.zeros(max(needed, 2 * len(self._bits)), dtype=np.uint8)
+            grown[:len(self._bits)] = self._bits
+            self._bits = grown
+
+    def _to_bits(self):
+        # Filled before it is published: readers never see a half-built bitmap
+        keys = self._array.astype(np.int64)
+        bits = np.zeros(int(keys[-1]) // 8 + 1, dtype=np.uint8)
+        np.bitwise_or.at(bits, keys >> 3, (1 << (keys & 7)).astype(np.uint8))
+        self._bits = bits
+        self._array = None
+
+    def contains(self, keys):
+        """Boolean mask, one entry per key"""
+        keys = np.asarray(keys, dtype=np.int64)
+        bits = self._bits
+        if bits is None:
+            array = self._array
+            pos = np.searchsorted(array, keys)
+            found = pos < len(array)
+            found[found] = array[pos[found]] == keys[found]
+            return found
+        found = (keys >= 0) & (keys < 8 * len(bits))
+        sel = keys[found]
+        found[found] = (bits[sel >> 3] >> (sel & 7)) & 1 == 1
+        return found
+
+    def to_array(self):
+        """Sorted keys in the set"""
+        if self._bits is None:
+            return self._array.copy()
+        return np.flatnonzero(np.unpackbits(self._bits, bitorder='little')).astype(np.int32)
+
+
+class ExclusionIndex:
+    """uid -> KeyBitmap of uids that user must not be recommended"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = {}         # uid -> stable int key
+        self._uids = []         # stable int key -> uid
+        self._bitmaps = {}      # uid -> KeyBitmap
+
+    def __getstate__(self):
+        # Shipped to neighbor-table / batch workers; the lock stays behind
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def key(self, uid):
+        key = self._keys.get(uid)
+        if key is None:
+            with self._lock:
+                key = self._keys.get(uid)
+                if key is None:
+                    key = self._keys[uid] = len(self._uids)
+                    self._uids.append(uid)
+        return key
+
+    def keys(self, uids):
+        """int32 key per uid (interning new ones), e.g. for a recommender's rows"""
+        return np.fromiter((self.key(uid) for uid in uids), dtype=np.int32, count=len(uids))
+
+    def add(self, uid, excluded_uids):
+        keys = [self.key(other) for other in excluded_uids if other and other != uid]
+        with self._lock:
+            bitmap = self._bitmaps.get(uid)
+            if bitmap is None:
+                bitmap = self._bitmaps[uid] = KeyBitmap()
+            bitmap.add(keys)
+
+    def excluded(self, uid, keys):
+        """Boolean mask over candidate keys; all False when uid has no exclusions"""
+        bitmap = self._bitmaps.get(uid)
+        if bitmap is None:
+            return np.zeros(len(keys), dtype=bool)
+        return bitmap.contains(keys)
+
+    def excluded_uids(self, uid):
+        """Every uid excluded for uid (e.g. to ship to a recommender shard)"""
+        bitmap = self._bitmaps.get(uid)
+        if bitmap is None:
+            return []
+        return [self._uids[key] for key in bitmap.to_array()]
+
+    def __contains__(self, uid):
+        return uid in self._bitmaps
+
+    def count(self, uid):
+        bitmap = self._bitmaps.get(uid)
+        return len(bitmap) if bitmap is not None else 0
+
+    def nbytes(self):
+        return sum(bitmap.nbytes for bitmap in self._bitmaps.values())
+
+
+class ExclusionFeed:
+    """
+    Firestore snapshot listeners that feed an ExclusionIndex
+
+    The first snapshot of each collection delivers every document, so
+    starting the feed is also the initial load; it calls on_reload once
+    instead of on_change per user. Only ADDED documents are read: every
+    message rewrites its conversation (lastMessage, timestamps), and
+    those MODIFIED changes never add an exclusion. Exclusions only grow:
+    deleting a conversation or skip does not re-admit the user.
+    """
+
+    def __init__(self, index, on_change=None, on_reload=None):
+        self.index = index
+        self.on_change = on_change      # called with the uid whose exclusions grew
+        self.on_reload = on_reload      # called after a collection's initial load
+        self._watches = []
+        self._loaded = set()            # collections whose first snapshot arrived
+
+    @property
+    def running(self):
+        return bool(self._watches)
+
+    def start(self):
+        db = get_firestore_client()
+        self._watches = [
+            db.collection('conversations').on_snapshot(self._on_conversations),
+            db.collection('skips').on_snapshot(self._on_skips),
+        ]
+        print("Watching conversations and skips for recommendation exclusions")
+
+    def stop(self):
+        for watch in self._watches:
+            watch.unsubscribe()
+        self._watches = []
+        self._loaded = set()
+
+    def _apply(self, collection, exclusions):
+        """Add (uid, excluded uids) pairs, then notify: once per uid, or one reload on the initial load"""
+        changed = set()
+        for uid, others in exclusions:
+            self.index.add(uid, others)
+            changed.add(uid)
+        if collection not in self._loaded:
+            self._loaded.add(collection)
+            if self.on_reload is not None:
+                self.on_reload()
+            return
+        if self.on_change is not None:
+            for uid in changed:
+                self.on_change(uid)
+
+    def _on_conversations(self, docs, changes, read_time):
+        exclusions = []
+        for change in changes:
+            if change.type.name != 'ADDED':
+                continue
+            participants = change.document.to_dict().get('participants') or []
+            exclusions.extend((uid, participants) for uid in participants)
+        self._apply('conversations', exclusions)
+
+    def _on_skips(self, docs, changes, read_time):
+        exclusions = []
+        for change in changes:
+            if change.type.name != 'ADDED':
+                continue
+            data = change.document.to_dict()
+            if data.get('uid') and data.get('skipped_uid'):
+                exclusions.append((data['uid'], [data['skipped_uid']]))
+        self._apply('skips', exclusions)
@@ -0,0 +1,192 @@
+"""
+Coordinates for profiles and a uniform lat/lng grid for distance queries
+
+Profiles store `location` as a free-text city. It is resolved once to a
+(latitude, longitude) centroid with the local table in
+app/data/city_centroids.csv (no geocoding API call); profiles that already
+carry `latitude`/`longitude` keep them.
+
+The grid has one cell per ``cell_deg`` x ``cell_deg`` degrees. Like the LSH
+index, cells are stored as one sorted code array, so collecting the rows of
+the cells covering a query circle is a vectorized binary search; rows are
+then checked with the exact haversine distance.
+"""
+import csv
+import math
+import os
+
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# ~28 km cells: a 50 km query covers a handful of cells
+DEFAULT_CELL_DEG = 0.25
+
+CENTROIDS_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), 'data', 'city_centroids.csv'
+)
+
+_centroids = None
+_regions = None
+
+
+def _normalize(text):
+    return ' '.join(str(text).lower().replace('.', '').split())
+
+
+def load_city_centroids(path=CENTROIDS_PATH):
+    """
+    Lookup of normalized "city, st" and bare "city" -> (lat, lng)
+    A bare city name resolves to the first (most populous) row listing it
+    """
+    global _centroids, _regions
+    if _centroids is None:
+        centroids, regions = {}, {}
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                coords = (float(row['latitude']), float(row['longitude']))
+                for key in (_normalize(f"{row['city']}, {row['state']}"), _normalize(row['city'])):
+                    centroids.setdefault(key, coords)
+                    regions.setdefault(key, row['state'])
+        _centroids, _regions = centroids, regions
+    return _centroids
+
+
+def resolve_location(location):
+    """(lat, lng) for a free-text city such as "Austin" or "Austin, TX"; None if unknown"""
+    if not isinstance(location, str) or not location.strip():
+        return None
+    centroids = load_city_centroids()
+    key = _normalize(location)
+    if key in centroids:
+        return centroids[key]
+    # "Austin, Texas" / "Austin, TX, USA": fall back to the city part
+    return centroids.get(key.split(',')[0].strip())
+
+
+def resolve_region(location):
+    """State code ("TX") of a free-text city, from the same table; None if unknown"""
+    if not isinstance(location, str) or not location.strip():
+        return None
+    load_city_centroids()
+    key = _normalize(location)
+    if key in _regions:
+        return _regions[key]
+    return _regions.get(key.split(',')[0].strip())
+
+
+def _finite(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def profile_coordinates(profile):
+    """(lat, lng) for one profile dict: its own coordinates, else its city centroid"""
+    lat, lng = _finite(profile.get('latitude')), _finite(profile.get('longitude'))
+    if lat is not None and lng is not None:
+        return lat, lng
+    return resolve_location(profile.get('location'))
+
+
+def frame_coordinates(df):
+    """(n, 2) float32 lat/lng for a profile DataFrame, NaN where unknown"""
+    coords = np.full((len(df), 2), np.nan, dtype=np.float32)
+    columns = [c for c in ('latitude', 'longitude', 'location') if c in df]
+    resolved = {}   # location string -> centroid, so each city is looked up once
+    for i, values in enumerate(df[columns].itertuples(index=False, name=None)):
+        profile = dict(zip(columns, values))
+        lat, lng = _finite(profile.get('latitude')), _finite(profile.get('longitude'))
+        if lat is None or lng is None:
+            location = profile.get('location')
+            if location not in resolved:
+                resolved[location] = resolve_location(location)
+            if resolved[location] is None:
+                continue
+            lat, lng = resolved[location]
+        coords[i] = (lat, lng)
+    return coords
+
+
+def haversine_km(lat, lng, lats, lngs):
+    """Great-circle distance from one point to arrays of points"""
+    lat, lng = math.radians(lat), math.radians(lng)
+    lats, lngs = np.radians(lats), np.radians(lngs)
+    a = (np.sin((lats - lat) / 2) ** 2
+         + math.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class GeoGridIndex:
+    """Rows bucketed by lat/lng grid cell"""
+
+    def __init__(self, cell_deg=DEFAULT_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.n_lat_cells = int(math.ceil(180 / cell_deg))
+        self.n_lng_cells = int(math.ceil(360 / cell_deg))
+
+        self.sorted_codes = np.empty(0, dtype=np.int64)
+        self.sorted_rows = np.empty(0, dtype=np.int32)
+        self.pending_rows = []      # rows added/moved since fit, checked directly
+
+    def _lat_cells(self, lats):
+        return np.clip(np.floor((lats + 90) / self.cell_deg), 0, self.n_lat_cells - 1).astype(np.int64)
+
+    def _lng_cells(self, lngs):
+        return np.floor((lngs + 180) / self.cell_deg).astype(np.int64) % self.n_lng_cells
+
+    def fit(self, coords):
+        located = np.flatnonzero(~np.isnan(coords[:, 0]))
+        codes = (self._lat_cells(coords[located, 0]) * self.n_lng_cells
+                 + self._lng_cells(coords[located, 1]))
+        order = np.argsort(codes, kind='stable')
+        self.sorted_codes = codes[order]
+        self.sorted_rows = located[order].astype(np.int32)
+        self.pending_rows = []
+        return self
+
+    def add(self, row):
+        """Register a row whose coordinates were set or changed after fit()"""
+        self.pending_rows.append(row)
+
+    def _covering_codes(self, lat, lng, radius_km):
+        lat_span = radius_km / KM_PER_DEGREE
+        lat_cells = np.arange(
+            self._lat_cells(np.array([lat - lat_span]))[0],
+            self._lat_cells(np.array([lat + lat_span]))[0] + 1
+        )
+
+        # Widest longitude span at the edge of the circle nearest a pole
+        cos_lat = math.cos(math.radians(min(abs(lat) + lat_span, 90)))
+        if cos_lat * KM_PER_DEGREE * 180 <= radius_km:
+            lng_cells = np.arange(self.n_lng_cells)
+        else:
+            lng_span = min(radius_km / (KM_PER_DEGREE * max(cos_lat, 1e-6)), 180)
+            first = int(math.floor((lng - lng_span + 180) / self.cell_deg))
+            last = int(math.floor((lng + lng_span + 180) / self.cell_deg))
+            lng_cells = np.unique(np.arange(first, last + 1) % self.n_lng_cells)
+
+        return (lat_cells[:, None] * self.n_lng_cells + lng_cells[None, :]).ravel()
+
+    def query(self, lat, lng, radius_km, coords):
+        """Sorted row ids within radius_km of (lat, lng), per coords (n, 2)"""
+        codes = self._covering_codes(lat, lng, radius_km)
+        lo = np.searchsorted(self.sorted_codes, codes, side='left')
+        hi = np.searchsorted(self.sorted_codes, codes, side='right')
+        found = [self.sorted_rows[a:b] for a, b in zip(lo, hi) if b > a]
+        if self.pending_rows:
+            found.append(np.asarray(self.pending_rows, dtype=np.int32))
+        if not found:
+            return np.empty(0, dtype=np.int32)
+
+        rows = np.unique(np.concatenate(found))
+        rows = rows[~np.isnan(coords[rows, 0])]
+        distances = haversine_km(lat, lng, coords[rows, 0], coords[rows, 1])
+        return rows[distances <= radius_km]
+
+    def nbytes(self):
+        return self.sorted_codes.nbytes + self.sorted_rows.nbytes
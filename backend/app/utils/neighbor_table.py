@@ -0,0 +1,173 @@
+"""
+Blocked top-K scoring for many users at once
+
+Used for the precomputed neighbor table (every row) and for batch
+recommendations (a list of uids). Query rows of the (L2-normalised) feature
+matrix, or of the dense embedding when the recommender has one, are
+processed in blocks: each block is one matrix x dense product against the
+whole matrix, so memory per block is bounded by ``block_rows * n_users``
+floats, and the orientation/gender filter is a single gather from the
+bucket compatibility table. Blocks are spread over a process pool and the
+result is int32 neighbor row ids and float32 scores (padded with -1 / NaN).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.preprocessing import normalize
+
+
+DEFAULT_TOP_K = 50
+
+# Upper bound on the dense similarity block held by one worker at a time
+BLOCK_BYTES = 64 * 1024 * 1024
+
+# Per-process state, populated once by _init_worker
+_worker_state = None
+
+
+def scoring_state(recommender):
+    """
+    Everything a block reads from a fitted recommender, captured at once
+
+    Masks, bucket codes, row keys and uids are copied (O(n_users), small),
+    so upserts or a compaction applied while a long batch runs cannot
+    remap rows under it: every row id yielded refers to this capture.
+    Call it on the thread that applies upserts (the event loop when serving).
+    """
+    n_users = recommender.feature_matrix.shape[0]
+    row_keys = recommender.row_keys
+    return {
+        'feature_matrix': recommender.feature_matrix,
+        'embedding': recommender.embedding[:n_users] if recommender.embedding is not None else None,
+        'bucket_codes': recommender.bucket_codes[:n_users].copy(),
+        'active': recommender.active[:n_users].copy(),
+        'compatibility': recommender.compatibility,
+        'uids': recommender.store.columns['uid'][:n_users].copy(),
+        'row_keys': row_keys[:n_users].copy() if row_keys is not None else None,
+        'exclusions': recommender.exclusions,
+    }
+
+
+def _scoring_matrix(state):
+    if state['embedding'] is not None:
+        # dense mode: rows are already L2-normalised
+        return state['embedding']
+    return normalize(state['feature_matrix'], norm='l2', copy=True).tocsr()
+
+
+def _init_worker(state):
+    global _worker_state
+    _worker_state = {**state, 'matrix': _scoring_matrix(state)}
+
+
+def _worker_top_k_block(rows, top_k):
+    return _top_k_block(_worker_state, rows, top_k)
+
+
+def _top_k_block(state, rows, top_k):
+    """Top-K compatible neighbors for a block of query rows, fully vectorized"""
+    X = state['matrix']
+    n_users = X.shape[0]
+
+    # (n_users x F) @ (F x block) dense -> dense (block x n_users)
+    block = X[rows].T
+    sims = np.asarray(X @ (block.toarray() if hasattr(block, 'toarray') else block)).T
+
+    # Compatibility filter as one table gather: allowed[i, j] = table[bucket(q_i), bucket(j)]
+    codes = state['bucket_codes']
+    active = state['active']
+    allowed = state['compatibility'][codes[rows]][:, codes]
+    allowed &= active
+    allowed[~active[rows]] = False
+    allowed[np.arange(len(rows)), rows] = False
+    exclusions = state['exclusions']
+    if exclusions is not None:
+        # Already messaged / skipped, only for the query users that have any
+        uids = state['uids']
+        keys = state['row_keys']
+        for i, row in enumerate(rows):
+            if uids[row] in exclusions:
+                allowed[i] &= ~exclusions.excluded(uids[row], keys)
+    sims = np.where(allowed, sims, -np.inf)
+
+    k = min(top_k, n_users)
+    top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    top_sims = np.take_along_axis(sims, top, axis=1)
+    order = np.argsort(-top_sims, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    top_sims = np.take_along_axis(top_sims, order, axis=1)
+
+    found = np.isfinite(top_sims)
+    ids = np.full((len(rows), top_k), -1, dtype=np.int32)
+    scores = np.full((len(rows), top_k), np.nan, dtype=np.float32)
+    ids[:, :k] = np.where(found, top, -1)
+    scores[:, :k] = np.where(found, top_sims, np.nan)
+    return rows, ids, scores
+
+
+def _row_blocks(rows, block_rows):
+    return [rows[start:start + block_rows] for start in range(0, len(rows), block_rows)]
+
+
+def iter_top_k(state, rows, top_k=DEFAULT_TOP_K, block_rows=None, n_jobs=None):
+    """
+    Score many query rows against the whole matrix, one block at a time
+
+    Args:
+        state: scoring_state() of a fitted HybridRecommender
+        rows: query row ids (in the state's numbering)
+        top_k: neighbors kept per query row
+        block_rows: rows per block (default: sized to BLOCK_BYTES)
+        n_jobs: worker processes (default: CPU count, 1 = run in-process).
+            The pool forks: pass 1 from a server process with live gRPC
+            threads (Firestore listeners), which a fork can deadlock
+
+    Yields:
+        (rows, ids, scores) per block, in input order: int32 neighbor row ids
+        and float32 scores of shape (len(rows), top_k), padded with -1 / NaN
+    """
+    n_users = state['feature_matrix'].shape[0]
+    rows = np.asarray(rows, dtype=np.int64)
+    if block_rows is None:
+        block_rows = max(1, BLOCK_BYTES // (8 * max(n_users, 1)))
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    blocks = _row_blocks(rows, block_rows)
+
+    if n_jobs == 1 or len(blocks) <= 1:
+        # Local state: concurrent in-process runs (threads) never share it
+        local = {**state, 'matrix': _scoring_matrix(state)}
+        for block in blocks:
+            yield _top_k_block(local, block, top_k)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=min(n_jobs, len(blocks)),
+        initializer=_init_worker,
+        initargs=(state,)
+    ) as pool:
+        futures = [pool.submit(_worker_top_k_block, block, top_k) for block in blocks]
+        for future in futures:
+            yield future.result()
+
+
+def build_neighbor_table(recommender, top_k=DEFAULT_TOP_K, block_rows=None, n_jobs=None):
+    """
+    Compute the top-K compatible neighbors of every row in a fitted recommender
+
+    Returns:
+        (ids, scores): int32 and float32 arrays of shape (n_users, top_k)
+    """
+    n_users = recommender.feature_matrix.shape[0]
+    ids = np.full((n_users, top_k), -1, dtype=np.int32)
+    scores = np.full((n_users, top_k), np.nan, dtype=np.float32)
+
+    for rows, block_ids, block_scores in iter_top_k(
+        scoring_state(recommender), np.arange(n_users), top_k=top_k, block_rows=block_rows, n_jobs=n_jobs
+    ):
+        ids[rows] = block_ids
+        scores[rows] = block_scores
+
+    return ids, scores
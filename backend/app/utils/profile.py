@@ -1,10 +1,19 @@
 from firebase_admin import firestore
 from typing import Optional
+from datetime import datetime, timezone
+import math
+import threading
+import numpy as np
 import pandas as pd
 
 
 # Import the shared Firebase client from auth.py
 from app.utils.auth import get_firestore_client
+from app.utils.user_store import grow_array
+
+
+# Documents per page when streaming the profiles collection
+PROFILE_PAGE_SIZE = 1000
 
 def _get_db():
     """Lazy-load Firestore client to ensure Firebase is initialized"""
@@ -23,6 +32,7 @@ def get_user_profile(user_id):
     - sexual_orientation: str
     - age: int
     - location: str
+    - latitude / longitude: float (city centroid, set on profile update)
     - income_bracket: str
     - education_level: str
     - interest_tags: str
@@ -36,6 +46,23 @@ def get_user_profile(user_id):
         return None
 
 
+def get_user_profiles(user_ids, fields=None, page_size=PROFILE_PAGE_SIZE):
+    """
+    uid -> profile dict (None if missing) for many users, read in batched
+    gets of page_size documents; fields projects the documents
+    """
+    db = _get_db()
+    collection = db.collection('profiles')
+    profiles = dict.fromkeys(user_ids)
+    user_ids = list(profiles)
+    for start in range(0, len(user_ids), page_size):
+        refs = [collection.document(uid) for uid in user_ids[start:start + page_size]]
+        for doc in db.get_all(refs, field_paths=fields):
+            if doc.exists:
+                profiles[doc.id] = doc.to_dict()
+    return profiles
+
+
 def get_all_user_profiles():
     db = _get_db()
     profile_ref = db.collection('profiles')
@@ -51,6 +78,167 @@ def get_all_user_profiles():
     return profiles_list
 
 
+def _to_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return math.nan
+    return value
+
+
+class ProfileColumns:
+    """
+    Growable NumPy columns filled one profile at a time
+
+    Numeric fields are float64 (NaN = missing / invalid), the rest object
+    arrays. Capacity doubles, so appends stay amortized O(1).
+    """
+
+    def __init__(self, fields, numeric=()):
+        self.fields = list(fields)
+        self.numeric = set(numeric) & set(self.fields)
+        self.columns = {
+            field: np.empty(0, dtype=np.float64 if field in self.numeric else object)
+            for field in self.fields
+        }
+        self.n_rows = 0
+
+    def _write(self, row, record):
+        for field in self.fields:
+            value = record.get(field)
+            self.columns[field][row] = _to_float(value) if field in self.numeric else value
+
+    def append(self, record):
+        row = self.n_rows
+        for field in self.fields:
+            self.columns[field] = grow_array(self.columns[field], row + 1)
+        self._write(row, record)
+        self.n_rows = row + 1
+
+    def update(self, row, record):
+        self._write(row, record)
+
+    def drop(self, rows):
+        """Remove the given rows; the rest keep their order"""
+        keep = np.ones(self.n_rows, dtype=bool)
+        keep[list(rows)] = False
+        for field in self.fields:
+            self.columns[field] = self.columns[field][:self.n_rows][keep]
+        self.n_rows = int(keep.sum())
+
+    def column(self, field):
+        return self.columns[field][:self.n_rows]
+
+    def to_frame(self):
+        """DataFrame over the filled part of the columns (no copy)"""
+        return pd.DataFrame({field: self.columns[field][:self.n_rows] for field in self.fields}, copy=False)
+
+
+def _paged_profiles(query, page_size):
+    """Profile dicts of a query, fetched page_size documents at a time with a cursor"""
+    query = query.limit(page_size)
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        n_docs = 0
+        for doc in page.stream():
+            n_docs += 1
+            last = doc
+            profile = doc.to_dict()
+            profile.setdefault('uid', doc.id)
+            yield profile
+        if n_docs < page_size:
+            return
+
+
+def stream_profile_columns(fields, numeric=(), keep=None, page_size=PROFILE_PAGE_SIZE):
+    """
+    Read the profiles collection into ProfileColumns, requesting only the
+    given fields and paging with a document cursor, so only one page of
+    documents is held as dicts at a time
+
+    keep: optional predicate on the (projected) profile dict
+    """
+    db = _get_db()
+    query = db.collection('profiles').select(list(fields)).order_by('__name__')
+    columns = ProfileColumns(fields, numeric)
+    for profile in _paged_profiles(query, page_size):
+        if keep is None or keep(profile):
+            columns.append(profile)
+    return columns
+
+
+def get_profiles_changed_since(since, fields, page_size=PROFILE_PAGE_SIZE):
+    """Projected profiles whose `updatedAt` is newer than since (ISO timestamp), paged"""
+    db = _get_db()
+    query = (
+        db.collection('profiles')
+        .where('updatedAt', '>', since)
+        # updatedAt is read too: the page cursor is positioned by it
+        .select(list(dict.fromkeys(list(fields) + ['updatedAt'])))
+        .order_by('updatedAt')
+        .order_by('__name__')
+    )
+    return _paged_profiles(query, page_size)
+
+
 def get_all_user_profiles_from_csv():
     df = pd.read_csv("final_profiles.csv")
     return df
+
+
+def utc_timestamp(when=None):
+    """ISO-8601 UTC timestamp in the same format as JS Date.toISOString()"""
+    when = when or datetime.now(timezone.utc)
+    return when.astimezone(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+class ProfileChangeFeed:
+    """
+    Collects profile changes from a Firestore snapshot listener
+
+    Only documents whose `updatedAt` is newer than the watermark are
+    watched, so starting the feed never re-reads the whole collection.
+    Changes are buffered (latest per uid) until the caller drains them;
+    the buffer is kept when the feed is restarted on a newer watermark.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}      # uid -> (changed_at, profile dict or None if removed)
+        self._watch = None
+        self.since = None       # watermark of the running watch
+
+    @property
+    def running(self):
+        return self._watch is not None
+
+    def start(self, since):
+        db = _get_db()
+        query = db.collection('profiles').where('updatedAt', '>', since)
+        self._watch = query.on_snapshot(self._on_snapshot)
+        self.since = since
+        print(f"Watching profile changes since {since}")
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+            self.since = None
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            for change in changes:
+                doc = change.document
+                if change.type.name == 'REMOVED':
+                    self._pending[doc.id] = (utc_timestamp(), None)
+                    continue
+                profile = doc.to_dict()
+                profile.setdefault('uid', doc.id)
+                self._pending[doc.id] = (profile.get('updatedAt') or utc_timestamp(), profile)
+
+    def drain(self):
+        """Return and clear the buffered changes"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
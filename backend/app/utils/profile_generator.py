@@ -0,0 +1,110 @@
+"""
+Synthetic profile populations for load tests, up to millions of users
+
+Builds N profiles with the fields and value distributions of
+benchmark.synthetic_profiles() (the dataset process.py reads, plus
+locations), CHUNK_SIZE users at a time. Chunk k is sampled from
+default_rng([seed, k]) in a worker process and rendered there, so the
+output is identical for the same (users, seed, chunk size) whatever the
+number of workers, and the parent only writes chunks out in order.
+
+Output format follows the file extension: .csv, or .parquet (needs pyarrow).
+
+Usage (from backend/):
+    python -m app.utils.profile_generator --users 1000000 --output profiles.csv
+    python -m app.utils.profile_generator --users 10000000 --output profiles.parquet --workers 8
+"""
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from app.utils.benchmark import synthetic_profiles
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:   # CSV output only
+    pyarrow = pq = None
+
+
+MAX_USERS = 10_000_000
+CHUNK_SIZE = 100_000
+
+
+def generate_chunk(chunk, n_users, seed=0, chunk_size=CHUNK_SIZE):
+    """DataFrame of users chunk * chunk_size .. (exclusive) the next chunk's first"""
+    start = chunk * chunk_size
+    rng = np.random.default_rng([seed, chunk])
+    return synthetic_profiles(min(chunk_size, n_users - start), seed=seed, start=start, rng=rng)
+
+
+def _render_chunk(chunk, n_users, seed, chunk_size, fmt):
+    """Chunk ready to write: CSV bytes (header on the first chunk) or an Arrow table"""
+    df = generate_chunk(chunk, n_users, seed, chunk_size)
+    if fmt == 'parquet':
+        return pyarrow.Table.from_pandas(df, preserve_index=False)
+    return df.to_csv(index=False, header=chunk == 0).encode()
+
+
+def _rendered_chunks(n_users, seed, chunk_size, fmt, workers):
+    """Rendered chunks in order; at most 2 per worker in flight, so memory stays bounded"""
+    n_chunks = -(-n_users // chunk_size)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in range(n_chunks):
+            pending.append(pool.submit(_render_chunk, chunk, n_users, seed, chunk_size, fmt))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_profiles(path, n_users, seed=0, chunk_size=CHUNK_SIZE, workers=None):
+    """Generate n_users profiles into path (.csv or .parquet); returns seconds taken"""
+    if not 0 < n_users <= MAX_USERS:
+        raise ValueError(f"n_users must be between 1 and {MAX_USERS}")
+    fmt = 'parquet' if path.endswith('.parquet') else 'csv'
+    if fmt == 'parquet' and pq is None:
+        raise RuntimeError("Parquet output needs pyarrow (pip install pyarrow)")
+    workers = workers or os.cpu_count() or 1
+
+    start = time.perf_counter()
+    written = 0
+    if fmt == 'parquet':
+        writer = None
+        try:
+            for table in _rendered_chunks(n_users, seed, chunk_size, fmt, workers):
+                if writer is None:
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                written += table.num_rows
+                print(f"   -> {written}/{n_users} profiles")
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        with open(path, 'wb') as f:
+            for i, data in enumerate(_rendered_chunks(n_users, seed, chunk_size, fmt, workers)):
+                f.write(data)
+                written = min((i + 1) * chunk_size, n_users)
+                print(f"   -> {written}/{n_users} profiles")
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic profile population")
+    parser.add_argument('--users', type=int, default=1_000_000, help=f"profiles to generate (up to {MAX_USERS})")
+    parser.add_argument('--output', default='synthetic_profiles.csv', help=".csv or .parquet")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="profiles per chunk (part of the population's identity)")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    print(f"Generating {args.users} profiles into {args.output}...")
+    seconds = write_profiles(args.output, args.users, seed=args.seed,
+                             chunk_size=args.chunk_size, workers=args.workers)
+    print(f"Done in {seconds:.1f}s")
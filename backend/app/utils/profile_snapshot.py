@@ -0,0 +1,111 @@
+"""
+Local columnar copy of the profiles table, for O(changes) rebuilds
+
+Layout of a table directory:
+    manifest.json       format version, watermark, time of the last full read,
+                        fields, row count
+    <field>.npy         one column per field (float64 for numeric fields,
+                        object arrays for the rest)
+
+A rebuild loads the table, fetches only the profiles whose `updatedAt` is
+newer than its watermark (get_profiles_changed_since()), applies them and
+writes the table back with a new watermark. Deleted documents never show up
+as changes, so once the last full read is older than max_age_seconds the
+caller reads the collection in full again instead.
+
+A new table is written next to the old one and swapped in by rename; the
+caller holds the snapshot build lock (see recommender_snapshot.build_lock).
+"""
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from app.utils.profile import ProfileColumns
+
+
+PROFILE_TABLE_VERSION = 1
+
+
+def save_profile_table(columns, directory, watermark, full_read_at):
+    """Write the columns and watermark, replacing any previous table"""
+    tmp = f"{directory}.tmp.{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    for field in columns.fields:
+        np.save(os.path.join(tmp, f"{field}.npy"), columns.column(field), allow_pickle=True)
+    manifest = {
+        'version': PROFILE_TABLE_VERSION,
+        'watermark': watermark,
+        'full_read_at': full_read_at,
+        'created_at': time.time(),
+        'fields': columns.fields,
+        'numeric': sorted(columns.numeric),
+        'n_rows': columns.n_rows,
+    }
+    with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    old = f"{directory}.old.{os.getpid()}"
+    if os.path.isdir(directory):
+        os.rename(directory, old)
+    os.rename(tmp, directory)
+    shutil.rmtree(old, ignore_errors=True)
+    print(f"Profile table saved to {directory} ({columns.n_rows} profiles)")
+
+
+def load_profile_table(directory, fields, numeric=(), max_age_seconds=None):
+    """
+    (ProfileColumns, manifest) of a saved table; None if missing, of another
+    version or field list, or last read in full more than max_age_seconds ago
+    """
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if manifest.get('version') != PROFILE_TABLE_VERSION:
+        return None
+    if manifest.get('fields') != list(fields) or set(manifest.get('numeric', ())) != set(numeric) & set(fields):
+        print("Profile table has other fields, reading profiles in full")
+        return None
+    if max_age_seconds is not None and time.time() - manifest['full_read_at'] > max_age_seconds:
+        print("Profile table is due for a full read")
+        return None
+
+    columns = ProfileColumns(fields, numeric)
+    for field in columns.fields:
+        columns.columns[field] = np.load(os.path.join(directory, f"{field}.npy"), allow_pickle=True)
+    columns.n_rows = manifest['n_rows']
+    return columns, manifest
+
+
+def apply_profile_changes(columns, profiles, keep=None):
+    """
+    Upsert changed profiles into the columns by uid; a profile that keep()
+    rejects (e.g. moved to another partition) is removed instead.
+    Returns (upserted, removed) counts.
+    """
+    rows = {uid: row for row, uid in enumerate(columns.column('uid'))}
+    removed = set()
+    upserted = 0
+    for profile in profiles:
+        row = rows.get(profile['uid'])
+        if keep is not None and not keep(profile):
+            if row is not None:
+                removed.add(row)
+            continue
+        if row is None:
+            rows[profile['uid']] = columns.n_rows
+            columns.append(profile)
+        else:
+            columns.update(row, profile)
+            removed.discard(row)
+        upserted += 1
+    if removed:
+        columns.drop(sorted(removed))
+    return upserted, len(removed)
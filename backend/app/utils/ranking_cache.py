@@ -0,0 +1,163 @@
+"""
+Per-user cache of ranked match lists, paged with opaque cursors
+
+A user's ranking is kept as a uid array + float32 scores, best first.
+Pages are slices of that list, so paging within it never rescores. It is
+filled lazily: the first request ranks only ``chunk`` candidates, small
+enough for the fast paths (neighbor table, LSH, shared tags) to serve it,
+and a cursor past the end extends it (doubling, up to ``depth``). With
+the engagement re-rank, every fill still retrieves at least RETRIEVE_K
+candidates by similarity and re-ranks those, so a user outside the first
+chunk by similarity can still reach page 1. Pages
+already served keep their order; an extension only appends users not
+listed yet. Entries are keyed by model generation and expire after
+``ttl_seconds``; the least recently used entry is evicted past
+``max_entries``.
+
+Uids (not row ids) are cached so compaction of the model cannot make a
+cached list point at the wrong user; users removed since the ranking was
+computed are skipped when a page is served.
+"""
+import base64
+import binascii
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(generation, offset):
+    raw = f"{generation}:{offset}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(generation, offset) from an opaque cursor; raises InvalidCursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        generation, offset = base64.urlsafe_b64decode(padded).decode().split(':')
+        generation, offset = int(generation), int(offset)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor("Invalid cursor")
+    if offset < 0:
+        raise InvalidCursor("Invalid cursor")
+    return generation, offset
+
+
+class RankingCache:
+    """Bounded LRU + TTL map of (generation, uid, filters) -> ranked candidate list"""
+
+    def __init__(self, max_entries=5000, ttl_seconds=600, depth=500, chunk=40):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.depth = depth
+        self.chunk = min(chunk, depth)
+        # key -> (expires_at, (uids, similarities, rank scores, complete))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, ranking):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, ranking)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, uid):
+        """Drop every cached ranking of one user (their own profile changed)"""
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == uid]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _rank(self, recommender, uid, depth, rerank, filters):
+        """The top depth candidates as (uids, similarities, rank scores) and stage timings"""
+        if rerank:
+            # Retrieves max(RETRIEVE_K, depth) candidates, then keeps the re-ranked top depth
+            rows, sims, scores, timings = recommender.rank_two_stage(uid, top_n=depth, **filters)
+        else:
+            start = time.perf_counter()
+            rows, sims = recommender.rank(uid, top_n=depth, **filters)
+            scores = sims
+            timings = {'retrieval_ms': round(1000 * (time.perf_counter() - start), 3)}
+        ranking = (
+            recommender.store.columns['uid'][rows],
+            np.asarray(sims, dtype=np.float32),
+            np.asarray(scores, dtype=np.float32),
+        )
+        return ranking, timings
+
+    def page(self, recommender, uid, offset, limit, rerank=False, **filters):
+        """
+        One page of a user's ranking as plain records, the next offset (None
+        on the last page) and stage timings. Ranks on a miss, or extends the
+        cached ranking when the page reaches past it: similarity retrieval,
+        then the engagement re-rank (of the same candidates) when rerank is
+        set.
+
+        filters are passed to recommender.rank() and are part of the key.
+        """
+        key = (recommender.generation, uid, rerank, tuple(sorted(filters.items())))
+        ranking = self.get(key)
+        needed = offset + limit
+        if ranking is None or (len(ranking[0]) < needed and not ranking[3]):
+            served = len(ranking[0]) if ranking is not None else 0
+            depth = min(self.depth, max(self.chunk, needed, 2 * served))
+            (uids, sims, scores), timings = self._rank(recommender, uid, depth, rerank, filters)
+            complete = len(uids) < depth or depth >= self.depth
+            if ranking is not None:
+                # Keep the order of what was already listed; append the rest
+                new = ~np.isin(uids, ranking[0])
+                uids = np.concatenate([ranking[0], uids[new]])
+                sims = np.concatenate([ranking[1], sims[new]])
+                scores = np.concatenate([ranking[2], scores[new]])
+            ranking = (uids, sims, scores, complete)
+            self.put(key, ranking)
+            timings['cache_hit'] = False
+        else:
+            timings = {'cache_hit': True}
+
+        uids, sims, scores, complete = ranking
+        uid_to_row = recommender.uid_to_row
+        rows, kept = [], []
+        position = offset
+        while position < len(uids) and len(rows) < limit:
+            row = uid_to_row.get(uids[position])
+            if row is not None:
+                rows.append(row)
+                kept.append(position)
+            position += 1
+
+        # Past the cached list: more may follow unless the ranking is complete
+        next_offset = position if position < len(uids) or not complete else None
+        if not rows:
+            return [], next_offset, timings
+        records = recommender.store.records(rows, sims[kept])
+        for record, rank_score in zip(records, scores[kept]):
+            record['rank_score'] = float(rank_score)
+        return records, next_offset, timings
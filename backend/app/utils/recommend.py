@@ -1,11 +1,23 @@
 from app.utils.profile import get_all_user_profiles, get_all_user_profiles_from_csv
+from app.utils.neighbor_table import build_neighbor_table, iter_top_k, scoring_state, DEFAULT_TOP_K
+from app.utils.user_store import UserStore, grow_array, INTERNED_FIELDS, SERVING_FIELDS
+from app.utils.ann_index import LSHIndex, DEFAULT_ANN_CONFIG
+from app.utils.geo_index import GeoGridIndex, frame_coordinates, profile_coordinates
+from app.utils.age_index import SortedAgeIndex
+from app.utils.tag_index import TagIndex
+from app.utils.tag_vocabulary import get_tag_vocabulary
+from app.utils.reranker import EngagementReranker, ENGAGEMENT_FEATURES
+from app.utils import recommender_snapshot
 
+import pickle
+import time
 import pandas as pd
 import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.compose import ColumnTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
 from scipy.sparse import hstack, csr_matrix
 
 
@@ -15,34 +27,355 @@ FEATURE_WEIGHTS = {
     'text': 2.0
 }
 
+# Compact the row buffers once this fraction of rows are tombstoned
+COMPACT_DEAD_RATIO = 0.5
+
+# Re-hash the ANN index once this fraction of rows changed since it was built
+ANN_REBUILD_RATIO = 0.05
+
+# Re-bucket the geo grid / re-sort the age index / re-index tags once this
+# fraction of rows changed since it was built
+GEO_REBUILD_RATIO = 0.05
+AGE_REBUILD_RATIO = 0.05
+TAG_REBUILD_RATIO = 0.05
+
+# Age windows wider than this fraction of rows are served by masking the
+# compatible list instead (a slice that large costs more than it saves)
+AGE_SLICE_MAX_FRACTION = 0.5
+# Same for tags whose posting lists together hold more than this fraction
+TAG_POSTINGS_MAX_FRACTION = 0.05
+
+# Serve from the neighbor table only while at most this many rows were
+# edited or appended since it was built (they are rescored per query)
+NEIGHBOR_MAX_CHANGED = 2000
+
+# Two-stage pipeline: candidates retrieved by similarity, and the time left
+# for re-ranking them (past it, the retrieval order is served as is)
+RETRIEVE_K = 300
+RERANK_BUDGET_MS = 20.0
+
+GENDER_CATEGORY_MAP = {
+    'Male': 'male', 'Transgender Male': 'male',
+    'Female': 'female', 'Transgender Female': 'female',
+    'Non-binary': 'non_binary', 'Genderfluid': 'non_binary',
+    'Transgender': 'transgender',
+    'Prefer Not to Say': 'other'
+}
+
+ORIENTATION_PREFERENCES = {
+    'Straight': {
+        'Male': ['female', 'transgender'],
+        'Female': ['male', 'transgender']
+    },
+    'Gay': {
+        'Male': ['male', 'transgender'],
+        'Female': ['female', 'transgender']
+    },
+    'Lesbian': {
+        'Female': ['female', 'transgender']
+    },
+    'Bisexual': {
+        'Male': ['female', 'male', 'transgender', 'non_binary'],
+        'Female': ['female', 'male', 'transgender', 'non_binary']
+    },
+    'Pansexual': {
+        'Male': ['female', 'male', 'transgender', 'non_binary'],
+        'Female': ['female', 'male', 'transgender', 'non_binary']
+    },
+    'Queer': {
+        'Male': ['female', 'male', 'transgender', 'non_binary'],
+        'Female': ['female', 'male', 'transgender', 'non_binary']
+    },
+    'Asexual': {
+        'Male': ['female', 'male', 'transgender', 'non_binary'],
+        'Female': ['female', 'male', 'transgender', 'non_binary']
+    },
+    'Demisexual': {
+        'Male': ['female', 'male', 'transgender', 'non_binary'],
+        'Female': ['female', 'male', 'transgender', 'non_binary']
+    },
+}
+
+GENDER_VALUES_BY_CATEGORY = {
+    'male': ['Male', 'Transgender Male'],
+    'female': ['Female', 'Transgender Female'],
+    'non_binary': ['Non-binary', 'Genderfluid'],
+    'transgender': ['Transgender Male', 'Transgender Female'],
+}
+
+# Integer codes for the filter. Every value outside these lists behaves the
+# same way under the preference rules, so they all share the last code.
+GENDER_VALUES = list(GENDER_CATEGORY_MAP)
+ORIENTATION_VALUES = list(ORIENTATION_PREFERENCES)
+N_GENDER_CODES = len(GENDER_VALUES) + 1
+N_ORIENTATION_CODES = len(ORIENTATION_VALUES) + 1
+
+
+def get_gender_category(g):
+    return GENDER_CATEGORY_MAP.get(g, 'other')
+
+
+def query_accepts(q_gender, q_orientation, c_gender):
+    """Does the query user's orientation accept the candidate's gender?"""
+    if q_orientation in ORIENTATION_PREFERENCES and q_gender in ORIENTATION_PREFERENCES[q_orientation]:
+        acceptable_gender_values = []
+        for cat in ORIENTATION_PREFERENCES[q_orientation][q_gender]:
+            acceptable_gender_values.extend(GENDER_VALUES_BY_CATEGORY[cat])
+        return c_gender in acceptable_gender_values
+    return True
+
+
+def candidate_accepts(c_gender, c_orientation, q_gender):
+    """
+    Does the candidate's orientation accept the query user's gender?
+    Note this side compares gender *categories*, not raw gender values
+    """
+    if c_orientation in ORIENTATION_PREFERENCES and c_gender in ORIENTATION_PREFERENCES[c_orientation]:
+        return get_gender_category(q_gender) in ORIENTATION_PREFERENCES[c_orientation][c_gender]
+    return True
+
+
+def is_compatible(q_gender, q_orientation, c_gender, c_orientation):
+    """Two-way check used by the recommender filter"""
+    return (query_accepts(q_gender, q_orientation, c_gender)
+            and candidate_accepts(c_gender, c_orientation, q_gender))
+
+
+def encode_buckets(genders, orientations):
+    """Map gender/orientation values to a single int16 bucket code per user"""
+    g = pd.Categorical(genders, categories=GENDER_VALUES).codes.astype(np.int16)
+    o = pd.Categorical(orientations, categories=ORIENTATION_VALUES).codes.astype(np.int16)
+    g[g < 0] = N_GENDER_CODES - 1
+    o[o < 0] = N_ORIENTATION_CODES - 1
+    return g * N_ORIENTATION_CODES + o
+
+
+def build_compatibility_table():
+    """
+    Boolean (n_buckets x n_buckets) lookup: table[query_bucket, candidate_bucket]
+    Built by evaluating the preference rules once per pair of buckets
+    """
+    genders = GENDER_VALUES + [None]
+    orientations = ORIENTATION_VALUES + [None]
+    buckets = [(g, o) for g in genders for o in orientations]
+
+    table = np.zeros((len(buckets), len(buckets)), dtype=bool)
+    for qi, (q_gender, q_orientation) in enumerate(buckets):
+        for ci, (c_gender, c_orientation) in enumerate(buckets):
+            table[qi, ci] = is_compatible(q_gender, q_orientation, c_gender, c_orientation)
+    return table
+
+
+class RowList:
+    """Sorted, growable int32 array of row ids"""
+
+    def __init__(self, rows):
+        self._buf = np.asarray(rows, dtype=np.int32)
+        self._n = len(self._buf)
+
+    @property
+    def rows(self):
+        return self._buf[:self._n]
+
+    def __len__(self):
+        return self._n
+
+    def insert(self, row):
+        pos = int(np.searchsorted(self.rows, row))
+        if pos < self._n and self._buf[pos] == row:
+            return
+        self._buf = grow_array(self._buf, self._n + 1)
+        self._buf[pos + 1:self._n + 1] = self._buf[pos:self._n].copy()
+        self._buf[pos] = row
+        self._n += 1
+
+    def remove(self, row):
+        pos = int(np.searchsorted(self.rows, row))
+        if pos == self._n or self._buf[pos] != row:
+            return
+        self._buf[pos:self._n - 1] = self._buf[pos + 1:self._n].copy()
+        self._n -= 1
+
+
+NUMERICAL_FEATURES = ['age']
+CATEGORICAL_FEATURES = [
+    'gender', 'sexual_orientation', 'location',
+    'income_bracket', 'education_level'
+]
+TEXT_FEATURE = 'interest_tags'
+PROFILE_FEATURE_FIELDS = NUMERICAL_FEATURES + CATEGORICAL_FEATURES + [TEXT_FEATURE]
+
+# Every profile field fit() reads (features, serving columns, coordinates,
+# engagement); loaders project documents onto these
+FIT_FIELDS = list(dict.fromkeys(
+    SERVING_FIELDS + PROFILE_FEATURE_FIELDS + ['latitude', 'longitude'] + ENGAGEMENT_FEATURES
+))
+NUMERIC_FIT_FIELDS = NUMERICAL_FEATURES + ['latitude', 'longitude'] + ENGAGEMENT_FEATURES
+
 
 class HybridRecommender:
-    def __init__(self, df, weights=FEATURE_WEIGHTS):
-        self.df = df.reset_index(drop=True)   # ensure clean index
+    def __init__(self, df, weights=FEATURE_WEIGHTS, ann_config=None, embedding_dim=None, compact=False):
+        # ensure clean index; released after fit(). None when loaded from a snapshot
+        self.df = df.reset_index(drop=True) if df is not None else None
         self.weights = weights
-        self.user_ids = df['uid'].tolist()
+        self.ann_config = ann_config   # e.g. DEFAULT_ANN_CONFIG to build an LSH index in fit()
+        self.embedding_dim = embedding_dim   # set to score with a dense low-rank embedding
+        # Compact memory layout: float32 feature values / norms, int32 CSR
+        # indices, repeated strings in the user store interned
+        self.compact_memory = compact
 
-        self.tfidf_vectorizer = TfidfVectorizer(stop_words='english', max_features=500)
+        # Interest tags are tokenized by the shared vocabulary: one TF-IDF term
+        # per normalized tag, the same ids the tag index and AI service use
+        self.tag_vocabulary = get_tag_vocabulary()
+        self.tfidf_vectorizer = TfidfVectorizer(analyzer=self.tag_vocabulary.tokens, max_features=500)
+        self._parsed_tags = None    # self.df's interest_tags as tag-id CSR while fitting
         self.preprocessor = self._setup_preprocessor()
         self.feature_matrix = None
 
-    def _setup_preprocessor(self):
-        numerical_features = ['age']
-        categorical_features = [
-            'gender', 'sexual_orientation', 'location',
-            'income_bracket', 'education_level'
-        ]
+        # Snapshot generation this model was loaded from / saved as (0 = never)
+        self.generation = 0
+        # UTC ISO time the training data was read at; profile changes after it are replayed
+        self.watermark = None
+
+        # Serving columns + uid -> row index (pandas-free, see user_store.py)
+        self.store = None
+
+        # Online updates: tombstone mask, growable CSR buffers, row L2 norms
+        self.active = None
+        self.row_norms = None
+        self._n_rows = 0
+        self._n_features = 0
+        self._data = None
+        self._indices = None
+        self._indptr = None
+
+        # Orientation/gender filter: per-row bucket code + bucket x bucket table
+        self.bucket_codes = None
+        self.compatibility = None
+
+        # Candidate index: bucket code -> RowList of compatible rows. Buckets
+        # whose compatibility row is identical share one list.
+        self.bucket_index = []
+        self._candidate_lists = []
+
+        # Optional approximate nearest-neighbor index (see app/utils/ann_index.py)
+        self.ann_index = None
+
+        # (n, 2) float32 lat/lng per row (NaN = unknown) + grid index (see app/utils/geo_index.py)
+        self.coords = None
+        self.geo_index = None
+
+        # Row ids sorted by age for min_age/max_age (see app/utils/age_index.py)
+        self.age_index = None
+
+        # Inverted interest-tag index for min_shared_tags (see app/utils/tag_index.py)
+        self.tag_index = None
+
+        # Second stage: (n, 3) float32 engagement z-scores + re-ranker (see app/utils/reranker.py)
+        self.reranker = None
+        self.engagement = None
+
+        # Optional dense mode: L2-normalised float32 rows from a truncated SVD
+        self.svd = None
+        self.embedding = None
+        self.embedding_report = None
 
+        # Already-messaged / skipped users (see app/utils/exclusions.py): shared
+        # ExclusionIndex + the stable exclusion key of every row
+        self.exclusions = None
+        self.row_keys = None
+
+        # Precomputed top-K table (see app/utils/neighbor_table.py)
+        self.neighbor_ids = None
+        self.neighbor_scores = None
+        self.neighbor_stale = None
+        self.neighbor_changed = []     # rows edited/appended since the build, in order
+
+
+    @property
+    def uid_to_row(self):
+        return self.store.index if self.store is not None else {}
+
+    @property
+    def user_ids(self):
+        return [self.store.columns['uid'][row] for row in self.store.index.values()]
+
+    def _setup_preprocessor(self):
         return ColumnTransformer(
             transformers=[
-                ('num', StandardScaler(), numerical_features),
-                ('cat', OneHotEncoder(handle_unknown='ignore', sparse_output=True), categorical_features)
+                ('num', StandardScaler(), NUMERICAL_FEATURES),
+                ('cat', OneHotEncoder(handle_unknown='ignore', sparse_output=True), CATEGORICAL_FEATURES)
             ],
             remainder='drop',
             verbose_feature_names_out=False
         )
 
-    def fit(self):
+    def fit_encoders(self):
+        """
+        Fit only the scaler/one-hot encoders, TF-IDF vocabulary and engagement
+        statistics on self.df; returns them (with the tag vocabulary) for
+        fit(encoders=...) on a shard
+        """
+        self.preprocessor.fit(self.df)
+        self.tfidf_vectorizer.fit(self._tag_docs())
+        self._parsed_tags = None
+        self.reranker = EngagementReranker()
+        self.reranker.fit_transform(self.df)
+        return self.preprocessor, self.tfidf_vectorizer, self.reranker, self.tag_vocabulary
+
+    def fit(self, encoders=None):
+        """
+        Build the model from self.df. encoders (from fit_encoders() on the
+        whole population) are reused instead of fitted here, so a shard
+        holding part of the users encodes them exactly like one big model
+        """
+        if encoders is not None:
+            print("1-3. Encoding features with the shared encoders...")
+            self.preprocessor, self.tfidf_vectorizer, self.reranker, self.tag_vocabulary = encoders
+            self._reset_rows(self._transform(self.df))
+        else:
+            self._reset_rows(self._fit_features())
+        print("   -> Final feature matrix shape:", self.feature_matrix.shape)
+
+        print("4. Encoding gender/orientation compatibility...")
+        self.bucket_codes = encode_buckets(self.df['gender'], self.df['sexual_orientation'])
+        self.compatibility = build_compatibility_table()
+        self._build_bucket_index()
+        print(f"   -> {len(self._candidate_lists)} distinct candidate lists")
+
+        self.neighbor_ids = self.neighbor_scores = self.neighbor_stale = None
+        self.neighbor_changed = []
+
+        print("5. Indexing coordinates...")
+        self.coords = frame_coordinates(self.df)
+        self.geo_index = GeoGridIndex().fit(self.coords)
+        print(f"   -> {len(self.geo_index.sorted_rows)} of {len(self.df)} users located")
+
+        print("6. Standardising engagement features for re-ranking...")
+        if encoders is not None:
+            self.engagement = self.reranker.transform(self.df)
+        else:
+            self.reranker = EngagementReranker()
+            self.engagement = self.reranker.fit_transform(self.df)
+
+        # Serving reads only from the columnar store from here on
+        self.store = UserStore.from_frame(self.df, interned=INTERNED_FIELDS if self.compact_memory else (),
+                                          tag_vocabulary=self.tag_vocabulary, tag_ids=self._parse_tags())
+        self.df = None
+        self._parsed_tags = None
+        self.age_index = SortedAgeIndex().fit(self.store.column('age'))
+        self.tag_index = TagIndex().fit(self.store)
+
+        self.svd = self.embedding = self.embedding_report = None
+        if self.embedding_dim:
+            self.build_embedding(self.embedding_dim)
+
+        self.ann_index = None
+        if self.ann_config:
+            self.build_ann_index(**self.ann_config)
+
+    def _fit_features(self):
+        """Steps 1-3 of fit(): fit the encoders and return the weighted feature matrix"""
         print("1. Processing numerical & categorical features...")
         X_other = self.preprocessor.fit_transform(self.df)
 
@@ -58,138 +391,982 @@ class HybridRecommender:
         print(f"   -> Categorical Features shape: {X_cat.shape}")
 
         print("2. Processing text features (interest_tags) with TF-IDF...")
-        X_text = self.tfidf_vectorizer.fit_transform(self.df['interest_tags'].fillna(''))
+        X_text = self.tfidf_vectorizer.fit_transform(self._tag_docs())
         print(f"   -> Text Features (TF-IDF) shape: {X_text.shape}")
 
         print("3. Combining & weighting features...")
+        return self._combine(X_num, X_cat, X_text)
+
+    def _parse_tags(self):
+        """self.df's interest_tags as tag-id CSR, parsed once per fit (kept by the store)"""
+        if self._parsed_tags is None:
+            self._parsed_tags = self.tag_vocabulary.parse_column(self.df['interest_tags'])
+        return self._parsed_tags
+
+    def _tag_docs(self):
+        """Per-row id arrays for the TF-IDF analyzer (TagVocabulary.tokens)"""
+        data, indptr = self._parse_tags()
+        return (data[a:b] for a, b in zip(indptr[:-1], indptr[1:]))
+
+    def _combine(self, X_num, X_cat, X_text):
         X_num *= self.weights['numerical']
         X_cat *= self.weights['categorical']
         X_text *= self.weights['text']
+        X = hstack([X_num, X_cat, X_text]).tocsr()
+        # Missing age scales to NaN; treat it as the population mean (0)
+        np.nan_to_num(X.data, copy=False)
+        return X
 
-        self.feature_matrix = hstack([X_num, X_cat, X_text]).tocsr()
-        print("   -> Final feature matrix shape:", self.feature_matrix.shape)
+    def _transform(self, df):
+        """Encode rows with the already-fitted preprocessor and TF-IDF vocabulary"""
+        X_other = csr_matrix(self.preprocessor.transform(df))
+        n_num_features = self.preprocessor.named_transformers_['num'].n_features_in_
 
-    def filter_function(self, query_uid):
-        GENDER_CATEGORY_MAP = {
-            'Male': 'male', 'Transgender Male': 'male',
-            'Female': 'female', 'Transgender Female': 'female',
-            'Non-binary': 'non_binary', 'Genderfluid': 'non_binary',
-            'Transgender': 'transgender',
-            'Prefer Not to Say': 'other'
+        X_num = X_other[:, :n_num_features]
+        X_cat = X_other[:, n_num_features:]
+        if df is self.df:
+            X_text = self.tfidf_vectorizer.transform(self._tag_docs())
+        else:
+            X_text = self.tfidf_vectorizer.transform(df['interest_tags'].fillna(''))
+        return self._combine(X_num, X_cat, X_text)
+
+    # ------------------------------------------------------------------
+    # Row storage
+    # ------------------------------------------------------------------
+    def _reset_rows(self, X):
+        """Take ownership of a CSR matrix as the row buffers (all rows live)"""
+        X = csr_matrix(X)
+        self._n_rows, self._n_features = X.shape
+        data_dtype, index_dtype = X.data.dtype, X.indices.dtype
+        if self.compact_memory:
+            data_dtype = np.float32
+            if X.nnz <= np.iinfo(np.int32).max:
+                index_dtype = np.int32
+        self._data = X.data.astype(data_dtype)
+        self._indices = X.indices.astype(index_dtype)
+        self._indptr = X.indptr.astype(index_dtype)   # same dtype as indices, so views are never re-cast
+        self.active = np.ones(self._n_rows, dtype=bool)
+        self.row_norms = np.sqrt(np.asarray(X.multiply(X).sum(axis=1)).ravel()).astype(data_dtype)
+        self._refresh_view()
+
+    def _refresh_view(self):
+        n, nnz = self._n_rows, self._indptr[self._n_rows]
+        self.feature_matrix = csr_matrix(
+            (self._data[:nnz], self._indices[:nnz], self._indptr[:n + 1]),
+            shape=(n, self._n_features),
+            copy=False
+        )
+
+    def _append_row(self, X_row):
+        row = self._n_rows
+        start = self._indptr[row]
+        end = start + X_row.nnz
+
+        if end > np.iinfo(self._indices.dtype).max:
+            self._indices = self._indices.astype(np.int64)
+            self._indptr = self._indptr.astype(np.int64)
+        self._data = grow_array(self._data, end)
+        self._indices = grow_array(self._indices, end)
+        self._indptr = grow_array(self._indptr, row + 2)
+        self.active = grow_array(self.active, row + 1)
+        self.row_norms = grow_array(self.row_norms, row + 1)
+
+        self._data[start:end] = X_row.data
+        self._indices[start:end] = X_row.indices
+        self._indptr[row + 1] = end
+        self.active[row] = True
+        self.row_norms[row] = np.linalg.norm(X_row.data)
+        self._n_rows = row + 1
+        self._refresh_view()
+        if self.neighbor_ids is not None:
+            self.neighbor_changed.append(row)
+        return row
+
+    def _overwrite_row(self, row, X_row):
+        """Replace a row in place; only possible when the stored nnz matches"""
+        start, end = self._indptr[row], self._indptr[row + 1]
+        if end - start != X_row.nnz:
+            return False
+        self._data[start:end] = X_row.data
+        self._indices[start:end] = X_row.indices
+        self.row_norms[row] = np.linalg.norm(X_row.data)
+        return True
+
+    # ------------------------------------------------------------------
+    # Online updates
+    # ------------------------------------------------------------------
+    def _profile_frame(self, profile):
+        return pd.DataFrame([{col: profile.get(col) for col in PROFILE_FEATURE_FIELDS}])
+
+    def upsert_user(self, profile):
+        """
+        Add or update a single user against the fitted encoders and TF-IDF
+        vocabulary (no refit). Returns the user's row id.
+
+        Categories or tags unseen at fit time are ignored, the same as
+        handle_unknown='ignore' does during a normal transform.
+        """
+        if self.feature_matrix is None:
+            raise RuntimeError("Model not fitted. Call .fit() first.")
+
+        uid = profile['uid']
+        row_df = self._profile_frame(profile)
+        X_row = self._transform(row_df)
+
+        bucket = encode_buckets(row_df['gender'], row_df['sexual_orientation'])[0]
+        coords = profile_coordinates(profile) or (np.nan, np.nan)
+        engagement = self.reranker.transform_one(profile)
+
+        row = self.uid_to_row.get(uid)
+        if row is not None and self._overwrite_row(row, X_row):
+            old_age = self.store.columns['age'][row]
+            old_tags = self.store.tag_ids(row).copy()
+            self.store.update(row, profile)
+            if not np.array_equal(old_age, self.store.columns['age'][row], equal_nan=True):
+                self._age_add(row)
+            if not np.array_equal(old_tags, self.store.tag_ids(row)):
+                self._tag_add(row)
+            self._move_bucket(row, self.bucket_codes[row], bucket)
+            self.bucket_codes[row] = bucket
+            self._write_embedding(row, X_row)
+            self._mark_stale(row)
+            self._ann_add(row)
+            self._write_row_key(row, uid)
+            self._write_coords(row, coords)
+            self.engagement[row] = engagement
+            return row
+
+        if row is not None:
+            self.active[row] = False
+
+        row = self._append_row(X_row)
+        self.store.append(profile)
+        self._age_add(row)
+        self._tag_add(row)
+        self.bucket_codes = grow_array(self.bucket_codes, row + 1)
+        self.bucket_codes[row] = bucket
+        self._move_bucket(row, None, bucket)
+        self._write_embedding(row, X_row)
+        self._ann_add(row)
+        self._write_row_key(row, uid)
+        self._write_coords(row, coords, new_row=True)
+        self.engagement = grow_array(self.engagement, row + 1)
+        self.engagement[row] = engagement
+        self._maybe_compact()
+        return self.uid_to_row[uid]
+
+    def remove_user(self, uid):
+        """Drop a user from future recommendations. Returns False if unknown."""
+        row = self.store.remove(uid) if self.store is not None else None
+        if row is None:
+            return False
+        self.active[row] = False
+        self._maybe_compact()
+        return True
+
+    def _maybe_compact(self):
+        n_dead = self._n_rows - len(self.uid_to_row)
+        if self._n_rows and n_dead / self._n_rows >= COMPACT_DEAD_RATIO:
+            self.compact()
+
+    def compact(self):
+        """Physically drop tombstoned rows and renumber the live ones"""
+        live = np.flatnonzero(self.active[:self._n_rows])
+        X = self.feature_matrix[live]
+        self.store.compact(live)
+        self.bucket_codes = self.bucket_codes[live]
+        if self.embedding is not None:
+            self.embedding = self.embedding[live]
+        if self.row_keys is not None:
+            self.row_keys = self.row_keys[live]
+        self.coords = self.coords[live]
+        self.engagement = self.engagement[live]
+
+        # old row id -> new row id (-1 for dropped rows), for the neighbor table
+        remap = np.full(self._n_rows + 1, -1, dtype=np.int32)
+        remap[live] = np.arange(len(live), dtype=np.int32)
+
+        self._reset_rows(X)
+        self._build_bucket_index()
+        self._remap_neighbor_table(live, remap)
+        if self.ann_index is not None:
+            self.ann_index.fit(self.feature_matrix)
+        self.geo_index.fit(self.coords)
+        self.age_index.fit(self.store.column('age'))
+        self.tag_index.fit(self.store)
+
+    # ------------------------------------------------------------------
+    # Geographic prefilter
+    # ------------------------------------------------------------------
+    def _write_coords(self, row, coords, new_row=False):
+        self.coords = grow_array(self.coords, row + 1)
+        if not new_row and np.array_equal(self.coords[row], coords, equal_nan=True):
+            return
+        self.coords[row] = coords
+        self.geo_index.add(row)
+        if len(self.geo_index.pending_rows) > GEO_REBUILD_RATIO * self._n_rows:
+            self.geo_index.fit(self.coords[:self._n_rows])
+
+    def nearby_rows(self, query_index, max_distance_km):
+        """
+        Compatible candidates within max_distance_km, read from the grid
+        cells covering that circle; None when the query user has no
+        coordinates (the caller then skips the distance filter)
+        """
+        lat, lng = self.coords[query_index]
+        if np.isnan(lat):
+            return None
+        rows = self.geo_index.query(lat, lng, max_distance_km, self.coords)
+        return self._compatible_subset(query_index, rows)
+
+    # ------------------------------------------------------------------
+    # Age-range prefilter
+    # ------------------------------------------------------------------
+    def _age_add(self, row):
+        self.age_index.add(row)
+        if len(self.age_index.pending_rows) > AGE_REBUILD_RATIO * self._n_rows:
+            self.age_index.fit(self.store.column('age'))
+
+    def age_range_rows(self, query_index, min_age=None, max_age=None):
+        """
+        Compatible candidates aged min_age..max_age (inclusive): a binary-
+        searched slice of the age index, filtered with one table gather
+        """
+        if self.age_index.count(min_age, max_age) > AGE_SLICE_MAX_FRACTION * self._n_rows:
+            rows = self.candidate_rows(query_index)
+            return rows[self._in_age_range(rows, min_age, max_age)]
+        rows = self.age_index.query(min_age, max_age, self.store.columns['age'])
+        return self._compatible_subset(query_index, rows)
+
+    def _in_age_range(self, rows, min_age, max_age):
+        ages = self.store.columns['age'][rows]
+        keep = ~np.isnan(ages)
+        if min_age is not None:
+            keep &= ages >= min_age
+        if max_age is not None:
+            keep &= ages <= max_age
+        return keep
+
+    # ------------------------------------------------------------------
+    # Shared-tag candidate generation
+    # ------------------------------------------------------------------
+    def _tag_add(self, row):
+        self.tag_index.add(row)
+        if len(self.tag_index.pending_rows) > TAG_REBUILD_RATIO * self._n_rows:
+            self.tag_index.fit(self.store)
+
+    def shared_tag_rows(self, query_index, min_shared=1):
+        """
+        Compatible candidates sharing at least min_shared interest tags with
+        the query user: the union of their tags' posting lists, one gather
+        """
+        tags = self.store.tag_ids(query_index)
+        if len(tags) < min_shared:
+            return np.empty(0, dtype=np.int32)
+        if self.tag_index.count(tags) > TAG_POSTINGS_MAX_FRACTION * self._n_rows:
+            rows = self.candidate_rows(query_index)
+            return rows[self.tag_index.query_mask(tags, self.store, self._n_rows, min_shared)[rows]]
+        rows = self.tag_index.query(tags, self.store, min_shared)
+        return self._compatible_subset(query_index, rows)
+
+    # ------------------------------------------------------------------
+    # Exclusions (already messaged / skipped)
+    # ------------------------------------------------------------------
+    def attach_exclusions(self, exclusions):
+        """Use a shared ExclusionIndex; interns the uid of every row"""
+        self.row_keys = exclusions.keys(self.store.columns['uid'][:self._n_rows])
+        self.exclusions = exclusions
+
+    def _write_row_key(self, row, uid):
+        if self.exclusions is None:
+            return
+        self.row_keys = grow_array(self.row_keys, row + 1)
+        self.row_keys[row] = self.exclusions.key(uid)
+
+    def excluded_mask(self, query_index, rows):
+        """Boolean mask over rows the query user already messaged or skipped"""
+        if self.exclusions is None:
+            return np.zeros(len(rows), dtype=bool)
+        query_uid = self.store.columns['uid'][query_index]
+        return self.exclusions.excluded(query_uid, self.row_keys[rows])
+
+    # ------------------------------------------------------------------
+    # Compatibility-bucket candidate index
+    # ------------------------------------------------------------------
+    def _build_bucket_index(self):
+        """Precompute the sorted compatible row ids for every query bucket"""
+        codes = self.bucket_codes[:self._n_rows]
+        live = self.active[:self._n_rows]
+        lists_by_pattern = {}
+        self.bucket_index = []
+        self._candidate_lists = []
+
+        for pattern in self.compatibility:
+            key = pattern.tobytes()
+            if key not in lists_by_pattern:
+                row_list = RowList(np.flatnonzero(pattern[codes] & live))
+                lists_by_pattern[key] = row_list
+                self._candidate_lists.append((pattern, row_list))
+            self.bucket_index.append(lists_by_pattern[key])
+
+    def _move_bucket(self, row, old_bucket, new_bucket):
+        """Move a row between buckets in every candidate list it belongs to"""
+        for pattern, row_list in self._candidate_lists:
+            was_in = old_bucket is not None and pattern[old_bucket]
+            if pattern[new_bucket] and not was_in:
+                row_list.insert(row)
+            elif was_in and not pattern[new_bucket]:
+                row_list.remove(row)
+
+    # ------------------------------------------------------------------
+    # Dense low-rank embedding
+    # ------------------------------------------------------------------
+    def _embed(self, X):
+        return normalize(self.svd.transform(X), norm='l2').astype(np.float32)
+
+    def build_embedding(self, dim, n_report_queries=50, k=10):
+        """
+        Fit a truncated SVD once and switch scoring to dense dot products
+
+        The report (also kept in self.embedding_report) gives per-user memory
+        for both representations and recall@k / latency of dense scoring
+        against the sparse path on a sample of users
+        """
+        dim = min(dim, self._n_features - 1)
+        print(f"Building {dim}-d embedding with truncated SVD...")
+        self.svd = TruncatedSVD(n_components=dim, random_state=0)
+        self.svd.fit(self.feature_matrix)
+
+        embedding = self._embed(self.feature_matrix)
+        self.embedding_report = self._embedding_report(embedding, n_report_queries, k)
+        self.embedding = embedding
+
+        print(f"   -> Embedding report: {self.embedding_report}")
+        return self.embedding_report
+
+    def _embedding_report(self, embedding, n_queries, k):
+        n = max(self._n_rows, 1)
+        sparse_bytes = self._data.itemsize * self.feature_matrix.nnz \
+            + self._indices.itemsize * self.feature_matrix.nnz + self._indptr.itemsize * (n + 1)
+
+        live = np.flatnonzero(self.active[:self._n_rows])
+        sample = np.random.default_rng(0).choice(live, size=min(n_queries, len(live)), replace=False)
+
+        hits = total = 0
+        sparse_time = dense_time = 0.0
+        for query_index in sample:
+            candidates = self.candidate_rows(query_index)
+
+            start = time.perf_counter()
+            sims = self._sparse_scores(query_index, candidates)
+            exact = set(candidates[top_k_indices(sims, k)])
+            sparse_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            sims = embedding[candidates] @ embedding[query_index]
+            approx = set(candidates[top_k_indices(sims, k)])
+            dense_time += time.perf_counter() - start
+
+            hits += len(exact & approx)
+            total += len(exact)
+
+        n_sample = max(len(sample), 1)
+        return {
+            'dim': embedding.shape[1],
+            'explained_variance': float(self.svd.explained_variance_ratio_.sum()),
+            'sparse_bytes_per_user': sparse_bytes / n,
+            'dense_bytes_per_user': embedding.shape[1] * embedding.itemsize,
+            'recall_at_k': hits / total if total else 1.0,
+            'k': k,
+            'sparse_ms': 1000 * sparse_time / n_sample,
+            'dense_ms': 1000 * dense_time / n_sample,
         }
 
-        ORIENTATION_PREFERENCES = {
-            'Straight': {
-                'Male': ['female', 'transgender'],
-                'Female': ['male', 'transgender']
-            },
-            'Gay': {
-                'Male': ['male', 'transgender'],
-                'Female': ['female', 'transgender']
-            },
-            'Lesbian': {
-                'Female': ['female', 'transgender']
-            },
-            'Bisexual': {
-                'Male': ['female', 'male', 'transgender', 'non_binary'],
-                'Female': ['female', 'male', 'transgender', 'non_binary']
-            },
-            'Pansexual': {
-                'Male': ['female', 'male', 'transgender', 'non_binary'],
-                'Female': ['female', 'male', 'transgender', 'non_binary']
-            },
-            'Queer': {
-                'Male': ['female', 'male', 'transgender', 'non_binary'],
-                'Female': ['female', 'male', 'transgender', 'non_binary']
-            },
-            'Asexual': {
-                'Male': ['female', 'male', 'transgender', 'non_binary'],
-                'Female': ['female', 'male', 'transgender', 'non_binary']
-            },
-            'Demisexual': {
-                'Male': ['female', 'male', 'transgender', 'non_binary'],
-                'Female': ['female', 'male', 'transgender', 'non_binary']
-            },
+    def _write_embedding(self, row, X_row):
+        if self.embedding is None:
+            return
+        self.embedding = grow_array(self.embedding, row + 1)
+        self.embedding[row] = self._embed(X_row)[0]
+
+    # ------------------------------------------------------------------
+    # Approximate nearest neighbors
+    # ------------------------------------------------------------------
+    def build_ann_index(self, **params):
+        """Hash every row into an LSH index (params: see DEFAULT_ANN_CONFIG)"""
+        config = {**DEFAULT_ANN_CONFIG, **params}
+        print(f"Building LSH index {config}...")
+        self.ann_index = LSHIndex(**config).fit(self.feature_matrix)
+        print(f"   -> LSH index: {self.ann_index.nbytes()} bytes")
+
+    def _ann_add(self, row):
+        if self.ann_index is None:
+            return
+        self.ann_index.add(row)
+        if len(self.ann_index.pending_rows) > ANN_REBUILD_RATIO * self._n_rows:
+            self.ann_index.fit(self.feature_matrix)
+
+    def ann_candidate_rows(self, query_index):
+        """
+        Compatible candidates from the LSH buckets only: the same filter as
+        candidate_rows(), applied as a gather over the (small) ANN result
+        """
+        rows = self.ann_index.query(self.feature_matrix[query_index])
+        return self._compatible_subset(query_index, rows)
+
+    def _compatible_subset(self, query_index, rows):
+        """The rows that pass the orientation/gender filter, as one table gather"""
+        keep = self.compatibility[self.bucket_codes[query_index]][self.bucket_codes[rows]]
+        keep &= self.active[rows]
+        keep &= rows != query_index
+        return rows[keep]
+
+    def measure_ann_recall(self, k=10, n_queries=100, seed=0):
+        """
+        Compare the ANN path with exact scoring on a sample of users
+
+        Returns recall@k (share of the exact top-k the ANN path also returns)
+        plus mean per-query latency of both paths and mean candidate counts
+        """
+        if self.ann_index is None:
+            raise RuntimeError("ANN index not built. Call .build_ann_index() first.")
+
+        live = np.flatnonzero(self.active[:self._n_rows])
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(live, size=min(n_queries, len(live)), replace=False)
+
+        hits = total = 0
+        exact_time = ann_time = 0.0
+        exact_candidates = ann_candidates = 0
+
+        for query_index in sample:
+            start = time.perf_counter()
+            candidates = self.candidate_rows(query_index)
+            sims = self.score_candidates(query_index, candidates)
+            exact = set(candidates[top_k_indices(sims, k)])
+            exact_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            approx_candidates = self.ann_candidate_rows(query_index)
+            sims = self.score_candidates(query_index, approx_candidates)
+            approx = set(approx_candidates[top_k_indices(sims, k)])
+            ann_time += time.perf_counter() - start
+
+            hits += len(exact & approx)
+            total += len(exact)
+            exact_candidates += len(candidates)
+            ann_candidates += len(approx_candidates)
+
+        n = max(len(sample), 1)
+        return {
+            'k': k,
+            'queries': len(sample),
+            'recall_at_k': hits / total if total else 1.0,
+            'exact_ms': 1000 * exact_time / n,
+            'ann_ms': 1000 * ann_time / n,
+            'exact_candidates': exact_candidates / n,
+            'ann_candidates': ann_candidates / n,
+        }
+
+    # ------------------------------------------------------------------
+    # Snapshots
+    # ------------------------------------------------------------------
+    def save(self, directory):
+        """Write a versioned snapshot (see app/utils/recommender_snapshot.py)"""
+        path = recommender_snapshot.save_snapshot(self, directory)
+        self.generation = recommender_snapshot.current_generation(directory)
+        return path
+
+    @classmethod
+    def load(cls, directory, max_age_seconds=None):
+        """
+        Memory-map a saved snapshot; None if missing, stale or another
+        version. The model keeps its own tag vocabulary (see tag_vocabulary.py)
+        """
+        return recommender_snapshot.load_snapshot(cls, directory, max_age_seconds=max_age_seconds)
+
+    # ------------------------------------------------------------------
+    # Memory accounting
+    # ------------------------------------------------------------------
+    def memory_report(self):
+        """
+        Bytes held per component (allocated buffers, so spare capacity for
+        appends counts) plus 'total'. Encoders are measured by pickled size.
+        The shared ExclusionIndex is reported but not part of the total.
+        """
+        def nbytes(arr):
+            return int(arr.nbytes) if arr is not None else 0
+
+        report = {
+            'feature_data': nbytes(self._data),
+            'feature_indices': nbytes(self._indices),
+            'feature_indptr': nbytes(self._indptr),
+            'row_norms': nbytes(self.row_norms),
+            'active': nbytes(self.active),
+            'bucket_codes': nbytes(self.bucket_codes),
+            'candidate_lists': sum(nbytes(row_list._buf) for _, row_list in self._candidate_lists),
+            'coords': nbytes(self.coords),
+            'engagement': nbytes(self.engagement),
+            'row_keys': nbytes(self.row_keys),
+            'embedding': nbytes(self.embedding),
+            'neighbor_table': nbytes(self.neighbor_ids) + nbytes(self.neighbor_scores) + nbytes(self.neighbor_stale),
         }
+        for name in ('ann_index', 'geo_index', 'age_index', 'tag_index'):
+            index = getattr(self, name)
+            report[name] = int(index.nbytes()) if index is not None else 0
+        if self.store is not None:
+            for field, size in self.store.nbytes().items():
+                report[f'store_{field}'] = int(size)
+        report['encoders'] = len(pickle.dumps(
+            (self.preprocessor, self.tfidf_vectorizer, self.svd, self.reranker), protocol=pickle.HIGHEST_PROTOCOL
+        ))
+        report['total'] = sum(report.values())
+        report['exclusions_shared'] = int(self.exclusions.nbytes()) if self.exclusions is not None else 0
+        return report
+
+    # ------------------------------------------------------------------
+    # Precomputed neighbor table
+    # ------------------------------------------------------------------
+    def build_neighbor_table(self, top_k=DEFAULT_TOP_K, n_jobs=None):
+        """Precompute every user's top-K compatible neighbors (batch job)"""
+        if self.feature_matrix is None:
+            raise RuntimeError("Model not fitted. Call .fit() first.")
+        print(f"Building top-{top_k} neighbor table for {self._n_rows} users...")
+        self.neighbor_ids, self.neighbor_scores = build_neighbor_table(self, top_k=top_k, n_jobs=n_jobs)
+        self.neighbor_stale = np.zeros(self._n_rows, dtype=bool)
+        self.neighbor_changed = []
+        print(f"   -> Neighbor table: {self.neighbor_ids.nbytes + self.neighbor_scores.nbytes} bytes")
+
+    def _mark_stale(self, row):
+        # Rows past the table are already listed as appended
+        if self.neighbor_stale is not None and row < len(self.neighbor_stale) and not self.neighbor_stale[row]:
+            self.neighbor_stale[row] = True
+            self.neighbor_changed.append(row)
+
+    def _remap_neighbor_table(self, live, remap):
+        if self.neighbor_ids is None:
+            return
+        kept = live[live < len(self.neighbor_ids)]
+        # -1 padding indexes remap[-1], which is also -1
+        self.neighbor_ids = remap[self.neighbor_ids[kept]]
+        self.neighbor_scores = self.neighbor_scores[kept]
+        self.neighbor_stale = self.neighbor_stale[kept]
+        self._index_neighbor_changes()
+
+    def _index_neighbor_changes(self):
+        """Recover neighbor_changed from the stale flags and row count (after a load or compaction)"""
+        if self.neighbor_ids is None:
+            self.neighbor_changed = []
+            return
+        edited = np.flatnonzero(self.neighbor_stale).tolist()
+        self.neighbor_changed = edited + list(range(len(self.neighbor_ids), self._n_rows))
 
-        def get_gender_category(g):
-            return GENDER_CATEGORY_MAP.get(g, 'other')
+    def _lookup_neighbors(self, query_index, top_n):
+        """
+        Serve (row ids, scores) from the precomputed table, or None when the
+        row is stale/new, too many rows changed since the build, or the
+        table can no longer fill top_n
 
-        # --- Get query user ---
-        user_row = self.df[self.df['uid'] == query_uid]
-        if user_row.empty:
+        Stored neighbors are re-checked against the current filter (active,
+        bucket, exclusions). Rows changed since the build are dropped from
+        the stored list and compete with a live score instead, so edits
+        (e.g. a new gender) and new users show up before the next build.
+        """
+        if self.neighbor_ids is None or query_index >= len(self.neighbor_ids):
+            return None
+        if self.neighbor_stale[query_index]:
+            return None
+        if len(self.neighbor_changed) > NEIGHBOR_MAX_CHANGED:
+            return None
+        changed = np.asarray(self.neighbor_changed, dtype=np.int32)
+
+        ids = self.neighbor_ids[query_index]
+        scores = self.neighbor_scores[query_index]
+        stored = ids >= 0
+        keep = stored.copy()
+        rows = ids[stored]
+        keep[stored] = (
+            self.compatibility[self.bucket_codes[query_index]][self.bucket_codes[rows]]
+            & self.active[rows]
+            & ~self.excluded_mask(query_index, rows)
+            & ~np.isin(rows, changed)
+        )
+
+        if keep.sum() >= top_n:
+            keep &= np.cumsum(keep) <= top_n
+        elif stored.all():
+            # table was truncated at K: rows past it may now belong in top_n
+            return None
+        ids, scores = ids[keep], scores[keep]
+
+        live = self._compatible_subset(query_index, changed)
+        live = live[~self.excluded_mask(query_index, live)]
+        if len(live) == 0:
+            return ids, scores
+        ids = np.concatenate([ids, live])
+        scores = np.concatenate([scores, self.score_candidates(query_index, live).astype(np.float32)])
+        top = top_k_indices(scores, top_n)
+        return ids[top], scores[top]
+
+    def candidate_rows(self, query_index):
+        """
+        Sorted int32 row ids that pass the two-way orientation/gender filter,
+        read from the bucket index (tombstoned rows and the query user dropped)
+        """
+        rows = self.bucket_index[self.bucket_codes[query_index]].rows
+        rows = rows[self.active[rows]]
+        return rows[rows != query_index]
+
+    def filter_function(self, query_uid):
+        query_index = self.uid_to_row.get(query_uid)
+        if query_index is None:
             return pd.Index([])
+        return pd.Index(self.candidate_rows(query_index))
 
-        query_user = user_row.iloc[0]
-        q_gender = query_user['gender']
-        q_orientation = query_user['sexual_orientation']
+    def score_candidates(self, query_index, candidates):
+        """Cosine similarity between one row and the given candidate rows"""
+        if self.embedding is not None:
+            return self.embedding[candidates] @ self.embedding[query_index]
+        return self._sparse_scores(query_index, candidates)
 
-        # Exclude themselves
-        candidate_df = self.df[self.df['uid'] != query_uid].copy()
+    def _sparse_scores(self, query_index, candidates):
+        return self._cosine(self.feature_matrix[query_index], self.row_norms[query_index], candidates)
 
-        # --- Query user's preference ---
-        acceptable_gender_values = []
-        if q_orientation in ORIENTATION_PREFERENCES and q_gender in ORIENTATION_PREFERENCES[q_orientation]:
-            pref_categories = ORIENTATION_PREFERENCES[q_orientation][q_gender]
-
-            for cat in pref_categories:
-                if cat == 'male':
-                    acceptable_gender_values.extend(['Male', 'Transgender Male'])
-                elif cat == 'female':
-                    acceptable_gender_values.extend(['Female', 'Transgender Female'])
-                elif cat == 'non_binary':
-                    acceptable_gender_values.extend(['Non-binary', 'Genderfluid'])
-                elif cat == 'transgender':
-                    acceptable_gender_values.extend(['Transgender Male', 'Transgender Female'])
-
-            candidate_df['pass_query_pref'] = candidate_df['gender'].isin(acceptable_gender_values)
+    def _cosine(self, query_row, query_norm, candidates):
+        """Cosine similarity of a (1, F) sparse row with the candidate rows"""
+        query_vec = query_row.toarray().ravel()
+        dots = self.feature_matrix[candidates] @ query_vec
+
+        norms = self.row_norms[candidates] * query_norm
+        return np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+
+    # ------------------------------------------------------------------
+    # Shards (see app/utils/sharded_recommender.py)
+    # ------------------------------------------------------------------
+    def query_vector(self, query_uid):
+        """
+        Everything another shard needs to score candidates for this user (no
+        row ids), or None when the user is not held by this model
+        """
+        row = self.uid_to_row.get(query_uid)
+        if row is None:
+            return None
+        return {
+            'uid': query_uid,
+            'bucket': int(self.bucket_codes[row]),
+            'vector': self.feature_matrix[row],
+            'norm': float(self.row_norms[row]),
+            'coords': tuple(float(c) for c in self.coords[row]),
+        }
+
+    def rank_external(self, query, top_n=10, max_distance_km=None, min_age=None,
+                      max_age=None, excluded_uids=None):
+        """
+        Exact rank() over this model's rows for a query user described by
+        query_vector(), possibly held by another shard. excluded_uids are the
+        query user's messaged/skipped users. Sparse scoring only: with shared
+        encoders every shard's rows and scores equal the unsharded model's.
+        """
+        empty = np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        if self.feature_matrix is None:
+            return empty
+
+        bucket = query['bucket']
+        lat, lng = query['coords']
+        if max_distance_km is not None and not np.isnan(lat):
+            rows = self.geo_index.query(lat, lng, max_distance_km, self.coords)
         else:
-            candidate_df['pass_query_pref'] = True
+            rows = self.bucket_index[bucket].rows
 
-        # --- Candidate's preference toward the query user ---
-        def candidate_likes_query_user(row):
-            gender = row['gender']
-            orientation = row['sexual_orientation']
-            if orientation in ORIENTATION_PREFERENCES and gender in ORIENTATION_PREFERENCES[orientation]:
-                return get_gender_category(q_gender) in ORIENTATION_PREFERENCES[orientation][gender]
-            return True
+        keep = self.compatibility[bucket][self.bucket_codes[rows]]
+        keep &= self.active[rows]
+        if min_age is not None or max_age is not None:
+            keep &= self._in_age_range(rows, min_age, max_age)
+        own = self.uid_to_row.get(query['uid'])
+        if own is not None:
+            keep &= rows != own
+        if excluded_uids:
+            excluded = [self.uid_to_row[uid] for uid in excluded_uids if uid in self.uid_to_row]
+            keep &= ~np.isin(rows, excluded)
+        rows = rows[keep]
+        if len(rows) == 0:
+            return empty
 
-        candidate_df['pass_candidate_pref'] = candidate_df.apply(candidate_likes_query_user, axis=1)
+        sims = self._cosine(query['vector'], query['norm'], rows)
+        top = top_k_indices(sims, top_n)
+        return rows[top], sims[top]
 
-        final_filtered = candidate_df[candidate_df['pass_query_pref'] & candidate_df['pass_candidate_pref']]
-        return final_filtered.index
+    def rank(self, query_uid, top_n=10, use_ann=False, max_distance_km=None,
+             min_age=None, max_age=None, min_shared_tags=None):
+        """
+        Top-N compatible (row ids, scores) for a user, best first; empty
+        arrays for an unknown user or when nobody passes the filter
 
-    def recommend(self, query_uid, top_n=10):
+        use_ann scores only the LSH candidates (approximate, sublinear) and
+        falls back to the exact path when they cannot fill top_n.
+        max_distance_km scores only users in the grid cells around the query
+        user (ignored when the query user has no coordinates); min_age /
+        max_age score only the matching slice of the age index.
+        min_shared_tags scores only users sharing that many interest tags
+        (candidate generation, approximate) and falls back to the set
+        without that requirement when they cannot fill top_n.
+        """
+        empty = np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
         if self.feature_matrix is None:
             print("Model not fitted. Call .fit() first.")
-            return pd.DataFrame()
+            return empty
 
-        user_rows = self.df[self.df['uid'] == query_uid]
-        if user_rows.empty:
+        query_index = self.uid_to_row.get(query_uid)
+        if query_index is None:
             print("User ID not found:", query_uid)
-            return pd.DataFrame()
+            return empty
+
+        # Prefilters: start from the narrow index (grid cells, age slice)
+        # instead of the full compatible list
+        candidates = None
+        if max_distance_km is not None:
+            candidates = self.nearby_rows(query_index, max_distance_km)
+        if min_age is not None or max_age is not None:
+            if candidates is None:
+                candidates = self.age_range_rows(query_index, min_age, max_age)
+            else:
+                candidates = candidates[self._in_age_range(candidates, min_age, max_age)]
+        if min_shared_tags:
+            shared = self.shared_tag_rows(query_index, min_shared_tags)
+            if candidates is not None:
+                shared = np.intersect1d(candidates, shared, assume_unique=True)
+            shared = shared[~self.excluded_mask(query_index, shared)]
+            if len(shared) >= top_n:
+                sims = self.score_candidates(query_index, shared)
+                top = top_k_indices(sims, top_n)
+                return shared[top], sims[top]
+        if candidates is not None:
+            candidates = candidates[~self.excluded_mask(query_index, candidates)]
+            if len(candidates) == 0:
+                return empty
+            sims = self.score_candidates(query_index, candidates)
+            top = top_k_indices(sims, top_n)
+            return candidates[top], sims[top]
 
-        query_index = user_rows.index[0]
-        filtered_indices = self.filter_function(query_uid)
+        if use_ann and self.ann_index is not None:
+            candidates = self.ann_candidate_rows(query_index)
+            candidates = candidates[~self.excluded_mask(query_index, candidates)]
+            if len(candidates) >= top_n:
+                sims = self.score_candidates(query_index, candidates)
+                top = top_k_indices(sims, top_n)
+                return candidates[top], sims[top]
 
-        if len(filtered_indices) == 0:
+        cached = self._lookup_neighbors(query_index, top_n)
+        if cached is not None:
+            return cached
+
+        candidates = self.candidate_rows(query_index)
+        candidates = candidates[~self.excluded_mask(query_index, candidates)]
+
+        if len(candidates) == 0:
             print("No suitable matches found.")
-            return pd.DataFrame()
+            return empty
+
+        sims = self.score_candidates(query_index, candidates)
+        top = top_k_indices(sims, top_n)
+        return candidates[top], sims[top]
+
+    def rank_two_stage(self, query_uid, top_n=10, retrieve_k=RETRIEVE_K,
+                       budget_ms=RERANK_BUDGET_MS, **filters):
+        """
+        Retrieval + re-ranking: the top max(retrieve_k, top_n) candidates by
+        similarity (rank(), all filters apply), re-scored with engagement
+        features and cut to top_n.
+
+        Returns (rows, similarities, scores, timings). When retrieval alone
+        used up budget_ms the re-rank is skipped and scores are the
+        similarities; timings says which happened.
+        """
+        start = time.perf_counter()
+        rows, sims = self.rank(query_uid, top_n=max(retrieve_k, top_n), **filters)
+        retrieved = time.perf_counter()
+        retrieval_ms = 1000 * (retrieved - start)
+        n_candidates = len(rows)
+
+        reranked = len(rows) > 0 and retrieval_ms < budget_ms
+        if reranked:
+            scores = self.reranker.score(sims, self.engagement[rows])
+            top = top_k_indices(scores, top_n)
+            rows, sims, scores = rows[top], sims[top], scores[top]
+        else:
+            rows, sims = rows[:top_n], sims[:top_n]
+            scores = sims
+        done = time.perf_counter()
+
+        timings = {
+            'retrieval_ms': round(retrieval_ms, 3),
+            'rerank_ms': round(1000 * (done - retrieved), 3),
+            'total_ms': round(1000 * (done - start), 3),
+            'candidates': n_candidates,
+            'reranked': bool(reranked),
+        }
+        return rows, sims, scores, timings
 
-        query_vec = self.feature_matrix.getrow(query_index)
-        candidate_matrix = self.feature_matrix[filtered_indices]
+    def recommend(self, query_uid, top_n=10, **filters):
+        """
+        Top-N compatible matches for a user as a list of plain records
+        (uid, name, gender, age, interest_tags, similarity_score), best first
 
-        sims = cosine_similarity(query_vec, candidate_matrix).flatten()
-        score_series = pd.Series(sims, index=filtered_indices)
+        filters: use_ann, max_distance_km, min_age, max_age, min_shared_tags (see rank())
+        """
+        rows, scores = self.rank(query_uid, top_n=top_n, **filters)
+        if len(rows) == 0:
+            return []
+        return self.store.records(rows, scores)
+
+    def recommend_batch(self, query_uids, top_n=10, n_jobs=1):
+        """
+        Exact top-N matches for many users in one pass
+
+        Query rows are scored in blocks (one matrix product per block, the
+        compatibility filter applied as a table gather), in-process by
+        default; n_jobs > 1 spreads blocks over a process pool (offline
+        jobs only, not from a serving thread). Returns a generator of
+        (uid, records) in input order as blocks finish; unknown uids yield
+        an empty list.
+
+        The model state is captured when this is called (call it from the
+        thread that applies upserts); the generator can then run on another
+        thread while upserts and compactions continue.
+        """
+        if self.feature_matrix is None:
+            raise RuntimeError("Model not fitted. Call .fit() first.")
+
+        query_uids = list(query_uids)
+        state = scoring_state(self)
+        rows = [self.uid_to_row.get(uid) for uid in query_uids]
+        known = np.array([row for row in rows if row is not None], dtype=np.int64)
+        return self._stream_batch(state, query_uids, rows, known, top_n, n_jobs)
+
+    def _stream_batch(self, state, query_uids, rows, known, top_n, n_jobs):
+        uids = state['uids']
+        position = 0
+        for _, ids, scores in iter_top_k(state, known, top_k=top_n, n_jobs=n_jobs):
+            for block_ids, block_scores in zip(ids, scores):
+                # Emit the unknown uids that precede this known one
+                while rows[position] is None:
+                    yield query_uids[position], []
+                    position += 1
+                yield query_uids[position], self._batch_records(uids, block_ids, block_scores)
+                position += 1
+
+        for uid in query_uids[position:]:
+            yield uid, []
+
+    def _batch_records(self, uids, ids, scores):
+        """Records of captured rows, read by uid from the current store (users removed since are skipped)"""
+        found = ids >= 0
+        rows, kept = [], []
+        for i, uid in zip(np.flatnonzero(found), uids[ids[found]]):
+            row = self.uid_to_row.get(uid)
+            if row is not None:
+                rows.append(row)
+                kept.append(i)
+        return self.store.records(rows, scores[kept])
+
+def top_k_indices(scores, k):
+    """Positions of the k largest scores, best first (argpartition + small sort)"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def _reference_filter(df, query_uid):
+    """Original row-by-row pandas filter, kept to verify the lookup table"""
+    # --- Get query user ---
+    user_row = df[df['uid'] == query_uid]
+    if user_row.empty:
+        return pd.Index([])
+
+    query_user = user_row.iloc[0]
+    q_gender = query_user['gender']
+    q_orientation = query_user['sexual_orientation']
+
+    # Exclude themselves
+    candidate_df = df[df['uid'] != query_uid].copy()
+
+    # --- Query user's preference ---
+    acceptable_gender_values = []
+    if q_orientation in ORIENTATION_PREFERENCES and q_gender in ORIENTATION_PREFERENCES[q_orientation]:
+        pref_categories = ORIENTATION_PREFERENCES[q_orientation][q_gender]
+
+        for cat in pref_categories:
+            if cat == 'male':
+                acceptable_gender_values.extend(['Male', 'Transgender Male'])
+            elif cat == 'female':
+                acceptable_gender_values.extend(['Female', 'Transgender Female'])
+            elif cat == 'non_binary':
+                acceptable_gender_values.extend(['Non-binary', 'Genderfluid'])
+            elif cat == 'transgender':
+                acceptable_gender_values.extend(['Transgender Male', 'Transgender Female'])
+
+        candidate_df['pass_query_pref'] = candidate_df['gender'].isin(acceptable_gender_values)
+    else:
+        candidate_df['pass_query_pref'] = True
+
+    # --- Candidate's preference toward the query user ---
+    def candidate_likes_query_user(row):
+        gender = row['gender']
+        orientation = row['sexual_orientation']
+        if orientation in ORIENTATION_PREFERENCES and gender in ORIENTATION_PREFERENCES[orientation]:
+            return get_gender_category(q_gender) in ORIENTATION_PREFERENCES[orientation][gender]
+        return True
+
+    candidate_df['pass_candidate_pref'] = candidate_df.apply(candidate_likes_query_user, axis=1)
+
+    final_filtered = candidate_df[candidate_df['pass_query_pref'] & candidate_df['pass_candidate_pref']]
+    return final_filtered.index
+
+
+def test_filter_equivalence():
+    """
+    Check the vectorized filter against the original pandas logic on one
+    user per (gender, orientation) pair, which covers every bucket pair
+    """
+    genders = GENDER_VALUES + ['Agender', '', None]
+    orientations = ORIENTATION_VALUES + ['Unknown', '', None]
+    rows = [
+        {'uid': f'u{i}', 'name': f'User {i}', 'age': 20 + i % 30, 'gender': g,
+         'sexual_orientation': o, 'location': 'City', 'income_bracket': 'Middle',
+         'education_level': 'Bachelor', 'interest_tags': 'music, travel'}
+        for i, (g, o) in enumerate((g, o) for g in genders for o in orientations)
+    ]
+    df = pd.DataFrame(rows)
+
+    recommender = HybridRecommender(df)
+    recommender.fit()
 
-        top_idx = score_series.nlargest(top_n).index
+    for uid in df['uid']:
+        expected = list(_reference_filter(df, uid))
+        actual = list(recommender.filter_function(uid))
+        assert actual == expected, f"Filter mismatch for {uid}: {actual} != {expected}"
 
-        result = self.df.loc[top_idx, ['uid', 'name', 'gender', 'age', 'interest_tags']].copy()
-        result['similarity_score'] = score_series.loc[top_idx].values
-        return result.sort_values(by='similarity_score', ascending=False)
+    print(f"Filter equivalence OK for {len(df)} users")
 
 
+def test_memory_budget(n_users=100000, budget_mb=40, compact=True):
+    """
+    Fit on synthetic users and fail when the model's memory report is over
+    a per-worker budget
+    """
+    import contextlib
+    import io
+    from app.utils.benchmark import synthetic_profiles
 
+    with contextlib.redirect_stdout(io.StringIO()):
+        recommender = HybridRecommender(synthetic_profiles(n_users), compact=compact)
+        recommender.fit()
+    report = recommender.memory_report()
+    total_mb = report['total'] / (1024 * 1024)
+    largest = sorted(report.items(), key=lambda item: -item[1])[1:6]
+    assert total_mb <= budget_mb, f"{total_mb:.1f} MB over the {budget_mb} MB budget; largest: {largest}"
+    print(f"Memory OK for {n_users} users: {total_mb:.1f} MB (budget {budget_mb} MB)")
 
 
 def test_recommend():
@@ -212,4 +1389,5 @@ def test_recommend():
 
 
 if __name__ == '__main__':
+    test_filter_equivalence()
     test_recommend()
@@ -0,0 +1,217 @@
+"""
+Save / load a fitted HybridRecommender as a versioned on-disk snapshot
+
+Layout of a snapshot directory:
+    CURRENT                 name of the live version directory
+    .build.lock             flock() taken while a process fits/saves a model
+    v<version>-g<generation>/
+        manifest.json       format version, creation time, row counts
+        state.pkl           fitted encoders, tag vocabulary, TF-IDF, SVD,
+                            LSH/geo/age/tag indexes, re-ranker, user store
+        <name>.npy          one file per array (feature matrix CSR buffers, masks,
+                            norms, bucket codes, coordinates, engagement, embedding,
+                            neighbor table)
+
+Arrays are loaded with np.load(mmap_mode='c'): pages come straight from the
+page cache and any later in-place update (upsert) is copy-on-write, so the
+files on disk are never modified by a running server.
+
+The same files are how uvicorn/gunicorn workers share one model: every
+worker maps the same pages, and the generation number in CURRENT tells a
+worker when another process has published a newer model to swap to.
+"""
+import json
+import os
+import pickle
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:   # Windows: no cross-process lock, builds may overlap
+    fcntl = None
+
+
+SNAPSHOT_VERSION = 9
+
+# attribute name -> how many leading entries are meaningful
+_ARRAY_LENGTHS = {
+    '_data': lambda r: r._indptr[r._n_rows],
+    '_indices': lambda r: r._indptr[r._n_rows],
+    '_indptr': lambda r: r._n_rows + 1,
+    'active': lambda r: r._n_rows,
+    'row_norms': lambda r: r._n_rows,
+    'bucket_codes': lambda r: r._n_rows,
+    'embedding': lambda r: r._n_rows,
+    'coords': lambda r: r._n_rows,
+    'engagement': lambda r: r._n_rows,
+    'neighbor_ids': lambda r: len(r.neighbor_ids),
+    'neighbor_scores': lambda r: len(r.neighbor_scores),
+    'neighbor_stale': lambda r: len(r.neighbor_stale),
+}
+
+_STATE_FIELDS = [
+    'weights', 'ann_config', 'embedding_dim', 'compact_memory',
+    'tag_vocabulary', 'tfidf_vectorizer', 'preprocessor', 'svd', 'embedding_report',
+    'compatibility', 'ann_index', 'geo_index', 'age_index', 'tag_index', 'reranker',
+    '_n_features', 'watermark',
+]
+
+
+def _current_name(directory):
+    try:
+        with open(os.path.join(directory, 'CURRENT')) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _current_version_dir(directory):
+    name = _current_name(directory)
+    if name is None:
+        return None
+    path = os.path.join(directory, name)
+    return path if os.path.isdir(path) else None
+
+
+def current_generation(directory):
+    """Generation of the published snapshot (0 if none); one small file read"""
+    name = _current_name(directory)
+    if not name or '-g' not in name:
+        return 0
+    try:
+        return int(name.rsplit('-g', 1)[1])
+    except ValueError:
+        return 0
+
+
+@contextmanager
+def build_lock(directory):
+    """Exclusive cross-process lock so only one worker fits and saves at a time"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.build.lock'), 'w') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def save_snapshot(recommender, directory):
+    """Write a new snapshot version and atomically point CURRENT at it"""
+    if recommender.feature_matrix is None:
+        raise RuntimeError("Model not fitted. Call .fit() first.")
+
+    os.makedirs(directory, exist_ok=True)
+    generation = current_generation(directory) + 1
+    name = f"v{SNAPSHOT_VERSION}-g{generation}"
+    path = os.path.join(directory, name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+    for attr, length in _ARRAY_LENGTHS.items():
+        arr = getattr(recommender, attr)
+        if arr is not None:
+            np.save(os.path.join(path, f"{attr}.npy"), np.ascontiguousarray(arr[:length(recommender)]))
+
+    state = {field: getattr(recommender, field) for field in _STATE_FIELDS}
+    state['store'] = recommender.store
+    with open(os.path.join(path, 'state.pkl'), 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    manifest = {
+        'version': SNAPSHOT_VERSION,
+        'generation': generation,
+        'created_at': time.time(),
+        'n_rows': int(recommender._n_rows),
+        'n_users': len(recommender.uid_to_row),
+        'n_features': int(recommender._n_features),
+    }
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    # Flip CURRENT atomically, then drop versions older than the previous one.
+    # Workers still mapping the previous generation keep valid pages: unlinked
+    # files stay readable for as long as they are mapped.
+    tmp = os.path.join(directory, f'CURRENT.tmp.{os.getpid()}')
+    with open(tmp, 'w') as f:
+        f.write(name)
+    os.replace(tmp, os.path.join(directory, 'CURRENT'))
+
+    for entry in os.listdir(directory):
+        if entry.startswith('v') and entry not in (name, f"v{SNAPSHOT_VERSION}-g{generation - 1}"):
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+    print(f"Recommender snapshot saved to {path}")
+    return path
+
+
+def read_manifest(directory):
+    path = _current_version_dir(directory)
+    if path is None:
+        return None
+    return _read_version_manifest(path)
+
+
+def _read_version_manifest(path):
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def load_snapshot(recommender_cls, directory, max_age_seconds=None):
+    """
+    Load the current snapshot, memory-mapping its arrays
+
+    Returns None when there is no snapshot, it was written by another format
+    version, or it is older than max_age_seconds - callers then fit from
+    scratch.
+    """
+    # Resolved once: manifest, state and arrays must all come from the same
+    # version even if another worker publishes while we read
+    path = _current_version_dir(directory)
+    if path is None:
+        return None
+    manifest = _read_version_manifest(path)
+    if manifest is None:
+        return None
+    if manifest.get('version') != SNAPSHOT_VERSION:
+        print(f"Ignoring recommender snapshot with version {manifest.get('version')}")
+        return None
+    if max_age_seconds is not None and time.time() - manifest['created_at'] > max_age_seconds:
+        print("Ignoring stale recommender snapshot")
+        return None
+
+    try:
+        with open(os.path.join(path, 'state.pkl'), 'rb') as f:
+            state = pickle.load(f)
+
+        recommender = recommender_cls(None)
+        for field in _STATE_FIELDS:
+            setattr(recommender, field, state.get(field))
+        recommender.store = state['store']
+
+        for attr in _ARRAY_LENGTHS:
+            file = os.path.join(path, f"{attr}.npy")
+            setattr(recommender, attr, np.load(file, mmap_mode='c') if os.path.exists(file) else None)
+    except FileNotFoundError:
+        # Two newer generations were published meanwhile and this one was
+        # cleaned up; the caller picks up the current one on its next poll
+        print(f"Recommender snapshot {path} was replaced while loading")
+        return None
+
+    recommender._n_rows = manifest['n_rows']
+    recommender.generation = manifest.get('generation', 0)
+    recommender._refresh_view()
+    recommender._build_bucket_index()
+    recommender._index_neighbor_changes()
+
+    print(f"Recommender snapshot loaded from {path} ({manifest['n_users']} users)")
+    return recommender
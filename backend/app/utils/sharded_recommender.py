@@ -0,0 +1,192 @@
+"""
+Sharded recommender: users partitioned over worker processes
+
+One HybridRecommender holds every user in one process, so a query is bound
+by one core and one address space. ShardedRecommender fits the encoders
+(scaler, one-hot, TF-IDF vocabulary, engagement statistics) once on the
+whole population, then partitions users by a stable hash of their uid into
+``n_shards`` slices. Each slice is encoded and held by its own worker
+process, so every shard's rows are identical to the single model's.
+
+A query is a scatter-gather:
+    1. the owning shard exports the query user's vector (query_vector())
+    2. every shard ranks its own rows against it in parallel (rank_external())
+    3. the coordinator merges the per-shard top-N lists with a heap
+
+so results match the unsharded exact path, and each shard scores only
+1/n_shards of the candidates.
+"""
+import heapq
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from app.utils.recommend import HybridRecommender, FEATURE_WEIGHTS
+
+
+# Per-process state, populated once by _init_shard
+_shard = None
+
+
+def shard_of(uid, n_shards):
+    """Shard that owns a uid; stable across processes (unlike hash())"""
+    return zlib.crc32(str(uid).encode()) % n_shards
+
+
+def _init_shard(df, encoders, weights):
+    global _shard
+    _shard = HybridRecommender(df, weights=weights)
+    _shard.fit(encoders=encoders)
+
+
+def _shard_size():
+    return len(_shard.uid_to_row)
+
+
+def _shard_query(uid):
+    return _shard.query_vector(uid)
+
+
+def _shard_rank(query, top_n, excluded_uids, filters):
+    """Best-first records of this shard's top-N for the query"""
+    rows, sims = _shard.rank_external(query, top_n=top_n, excluded_uids=excluded_uids, **filters)
+    if len(rows) == 0:
+        return []
+    return _shard.store.records(rows, sims)
+
+
+def _shard_upsert(profile):
+    _shard.upsert_user(profile)
+
+
+def _shard_remove(uid):
+    return _shard.remove_user(uid)
+
+
+class ShardedRecommender:
+    """HybridRecommender partitioned by uid over one worker process per shard"""
+
+    def __init__(self, df, n_shards=None, weights=FEATURE_WEIGHTS):
+        self.df = df.reset_index(drop=True)
+        self.n_shards = n_shards or os.cpu_count() or 1
+        self.weights = weights
+        self.exclusions = None
+        self.shard_sizes = []
+        self._pools = []
+
+    def fit(self):
+        """Fit the shared encoders, then fit every shard in its own process (in parallel)"""
+        print(f"Fitting encoders for {len(self.df)} users...")
+        encoders = HybridRecommender(self.df, weights=self.weights).fit_encoders()
+
+        owners = np.array([shard_of(uid, self.n_shards) for uid in self.df['uid']])
+        print(f"Fitting {self.n_shards} shards...")
+        self.close()
+        # One single-worker pool per shard: tasks for a shard always reach the
+        # process that holds it
+        self._pools = [
+            ProcessPoolExecutor(
+                max_workers=1,
+                initializer=_init_shard,
+                initargs=(self.df[owners == shard], encoders, self.weights)
+            )
+            for shard in range(self.n_shards)
+        ]
+        self.df = None
+        futures = [pool.submit(_shard_size) for pool in self._pools]
+        self.shard_sizes = [future.result() for future in futures]
+        print(f"   -> Users per shard: {self.shard_sizes}")
+        return self
+
+    def close(self):
+        for pool in self._pools:
+            pool.shutdown(wait=True, cancel_futures=True)
+        self._pools = []
+
+    def attach_exclusions(self, exclusions):
+        """Use a shared ExclusionIndex (the query user's exclusions are sent with each query)"""
+        self.exclusions = exclusions
+
+    def _owner(self, uid):
+        return self._pools[shard_of(uid, self.n_shards)]
+
+    def recommend(self, query_uid, top_n=10, **filters):
+        """
+        Top-N compatible matches as plain records, best first; the same
+        records as HybridRecommender.recommend() on the exact path
+
+        filters: max_distance_km, min_age, max_age (see HybridRecommender.rank())
+        """
+        if not self._pools:
+            raise RuntimeError("Model not fitted. Call .fit() first.")
+
+        query = self._owner(query_uid).submit(_shard_query, query_uid).result()
+        if query is None:
+            print("User ID not found:", query_uid)
+            return []
+        excluded_uids = self.exclusions.excluded_uids(query_uid) if self.exclusions else None
+
+        futures = [
+            pool.submit(_shard_rank, query, top_n, excluded_uids, filters)
+            for pool in self._pools
+        ]
+        ranked = [future.result() for future in futures]
+        merged = heapq.merge(*ranked, key=lambda record: -record['similarity_score'])
+        return list(islice(merged, top_n))
+
+    def upsert_user(self, profile):
+        """Add or update a user on its owning shard (no refit)"""
+        self._owner(profile['uid']).submit(_shard_upsert, profile).result()
+
+    def remove_user(self, uid):
+        """Drop a user from future recommendations. Returns False if unknown."""
+        return self._owner(uid).submit(_shard_remove, uid).result()
+
+
+def test_sharded_recommend(n_users=20000, shard_counts=(1, 2, 4), n_queries=200, top_n=10):
+    """
+    Check sharded results against one exact HybridRecommender on synthetic
+    users, and report query throughput per shard count
+    """
+    import contextlib
+    import io
+    from concurrent.futures import ThreadPoolExecutor
+    from app.utils.benchmark import synthetic_profiles
+
+    df = synthetic_profiles(n_users)
+    with contextlib.redirect_stdout(io.StringIO()):
+        single = HybridRecommender(df)
+        single.fit()
+    rng = np.random.default_rng(1)
+    uids = rng.choice(df['uid'].to_numpy(), n_queries, replace=False)
+    filters = [{}, {'max_distance_km': 50}, {'min_age': 25, 'max_age': 35}]
+
+    for n_shards in shard_counts:
+        with contextlib.redirect_stdout(io.StringIO()):
+            sharded = ShardedRecommender(df, n_shards=n_shards).fit()
+        try:
+            for i, uid in enumerate(uids[:50]):
+                options = filters[i % len(filters)]
+                expected = single.recommend(uid, top_n=top_n, **options)
+                actual = sharded.recommend(uid, top_n=top_n, **options)
+                expected_scores = [r['similarity_score'] for r in expected]
+                actual_scores = [r['similarity_score'] for r in actual]
+                assert np.allclose(actual_scores, expected_scores, atol=1e-6), \
+                    f"Score mismatch for {uid} {options}: {actual_scores} != {expected_scores}"
+
+            # Queries in flight from several threads keep every shard busy
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=4 * n_shards) as threads:
+                list(threads.map(lambda uid: sharded.recommend(uid, top_n=top_n), uids))
+            elapsed = time.perf_counter() - start
+        finally:
+            sharded.close()
+        print(f"{n_shards} shard(s): results match, {len(uids) / elapsed:.1f} queries/s")
+
+
+if __name__ == '__main__':
+    test_sharded_recommend()
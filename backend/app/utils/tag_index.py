@@ -0,0 +1,95 @@
+"""
+Inverted index from interest tag to the rows listing it
+
+Tags are the int ids of the shared TagVocabulary, read from the per-row
+id arrays of the UserStore (see user_store.py); the postings are one (tag
+id, row id) pair array sorted by tag, so the rows of a query user's tags
+are a handful of binary-searched slices. As with the
+LSH, geo and age indexes, rows whose tags changed (or that were appended)
+after fit() are kept in ``pending_rows``; their postings may be stale, so
+they are checked against their current tags instead.
+"""
+import numpy as np
+
+
+class TagIndex:
+    """Tag id -> sorted posting list of row ids"""
+
+    def __init__(self):
+        self.sorted_tags = np.empty(0, dtype=np.int32)
+        self.sorted_rows = np.empty(0, dtype=np.int32)
+        self.pending_rows = []
+
+    def fit(self, store):
+        """Index the current tags of every row of a UserStore"""
+        tag_ids, indptr = store.tag_csr()
+        rows = np.repeat(np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr))
+
+        order = np.lexsort((rows, tag_ids))
+        self.sorted_tags = tag_ids[order]
+        self.sorted_rows = rows[order]
+        self.pending_rows = []
+        return self
+
+    def add(self, row):
+        """Register a row whose tags were set or changed after fit()"""
+        self.pending_rows.append(row)
+
+    def _slices(self, tags):
+        lo = np.searchsorted(self.sorted_tags, tags, side='left')
+        hi = np.searchsorted(self.sorted_tags, tags, side='right')
+        return lo, hi
+
+    def count(self, tags):
+        """Postings of these tags as of fit() (pending rows not counted); for planning"""
+        lo, hi = self._slices(tags)
+        return int((hi - lo).sum())
+
+    def query(self, tags, store, min_shared=1):
+        """
+        Sorted row ids sharing at least min_shared of tags (distinct tag
+        ids); store holds the current tags of every row
+        """
+        lo, hi = self._slices(tags)
+        found = [self.sorted_rows[a:b] for a, b in zip(lo, hi) if b > a]
+        rows = np.concatenate(found) if found else np.empty(0, dtype=np.int32)
+
+        if min_shared <= 1:
+            rows = np.unique(rows)
+        else:
+            rows, counts = np.unique(rows, return_counts=True)
+            rows = rows[counts >= min_shared]
+        return self._with_pending(rows, tags, store, min_shared)
+
+    def query_mask(self, tags, store, n_rows, min_shared=1):
+        """query() as a boolean mask over n_rows; no sort, for tags listed by many rows"""
+        counts = np.zeros(n_rows, dtype=np.int32)
+        lo, hi = self._slices(tags)
+        for a, b in zip(lo, hi):
+            counts[self.sorted_rows[a:b]] += 1
+        mask = counts >= min_shared
+        if self.pending_rows:
+            pending, matched = self._pending_matches(tags, store, min_shared)
+            mask[pending] = False
+            mask[matched] = True
+        return mask
+
+    def _with_pending(self, rows, tags, store, min_shared):
+        """Replace the (possibly stale) postings of pending rows with a check of their current tags"""
+        if not self.pending_rows:
+            return rows.astype(np.int32)
+        pending, matched = self._pending_matches(tags, store, min_shared)
+        rows = rows[~np.isin(rows, pending)]
+        return np.union1d(rows, matched).astype(np.int32)
+
+    def _pending_matches(self, tags, store, min_shared):
+        """Pending rows, and those of them whose current tags share min_shared of tags"""
+        pending = np.unique(np.asarray(self.pending_rows, dtype=np.int32))
+        # One gather of their id arrays, one isin, one per-row count
+        ids, indptr = store.tag_csr(pending)
+        owner = np.repeat(np.arange(len(pending)), np.diff(indptr))
+        shared = np.bincount(owner[np.isin(ids, tags)], minlength=len(pending))
+        return pending, pending[shared >= min_shared]
+
+    def nbytes(self):
+        return self.sorted_tags.nbytes + self.sorted_rows.nbytes
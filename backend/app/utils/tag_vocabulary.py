@@ -0,0 +1,139 @@
+"""
+Interned vocabulary of interest tags, shared by the recommender and the AI service
+
+`interest_tags` is free comma-separated text. Tags are normalized
+(lowercase, single spaces, so "Board  Games" and "board games" are one tag)
+and interned to int ids; an interest_tags string parses to an int32 id
+array (listed order, duplicates dropped).
+
+A model parses every row once when it is fitted (parse_column()) and its
+UserStore keeps the per-row id arrays (CSR); the TF-IDF tokens, the tag
+index and the AI service's common interests all read those. ids() serves
+strings outside the store (profile edits, users no model holds) through a
+small LRU cache.
+
+Ids only mean something next to the vocabulary that issued them. A model
+keeps the vocabulary it was fitted with (it is part of its snapshot) and
+never swaps it for another: regional partitions each load their own, so
+anything labelling a model's ids must use that model's tag_vocabulary.
+The process vocabulary (get_tag_vocabulary()) seeds new fits and parses
+profiles no model holds.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Recently parsed interest_tags strings kept by ids() (least recently used
+# evicted); per-row arrays live in the UserStore, not here
+MAX_CACHED_TEXTS = 10000
+
+_EMPTY = np.empty(0, dtype=np.int32)
+
+
+def normalize_tag(tag):
+    return ' '.join(tag.lower().split())
+
+
+class TagVocabulary:
+    """Normalized tag <-> int id, plus a cache of parsed interest_tags strings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = {}          # normalized tag -> id
+        self.tags = []          # id -> normalized tag
+        self.labels = []        # id -> tag as first written (trimmed), for display
+        self._parsed = OrderedDict()    # interest_tags string -> int32 id array, LRU
+
+    def __getstate__(self):
+        # Snapshotted with the recommender: the parse cache and lock stay behind
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_parsed'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tags)
+
+    def tag_id(self, label):
+        """Id of one tag, added to the vocabulary if new"""
+        tag = normalize_tag(label)
+        tag_id = self._ids.get(tag)
+        if tag_id is None:
+            with self._lock:
+                tag_id = self._ids.get(tag)
+                if tag_id is None:
+                    tag_id = self._ids[tag] = len(self.tags)
+                    self.tags.append(tag)
+                    self.labels.append(label.strip())
+        return tag_id
+
+    def _parse(self, text):
+        if not isinstance(text, str) or not text:
+            return _EMPTY
+        seen = {}
+        for label in text.split(','):
+            if label.strip():
+                seen.setdefault(self.tag_id(label), None)
+        return np.fromiter(seen, dtype=np.int32, count=len(seen))
+
+    def ids(self, text):
+        """int32 tag ids of an interest_tags string, in listed order (read-only, cached)"""
+        if not isinstance(text, str) or not text:
+            return _EMPTY
+        try:
+            ids = self._parsed[text]
+            self._parsed.move_to_end(text)
+            return ids
+        except KeyError:
+            pass
+        ids = self._parse(text)
+        ids.flags.writeable = False
+        self._parsed[text] = ids
+        while len(self._parsed) > MAX_CACHED_TEXTS:
+            self._parsed.popitem(last=False)
+        return ids
+
+    def parse_column(self, texts):
+        """
+        Every string of a column parsed once, as CSR: (int32 ids, int64
+        indptr) with row i's ids at ids[indptr[i]:indptr[i + 1]]
+        """
+        parsed = {}     # repeated strings (interned columns) parsed once
+        per_row = []
+        for text in texts:
+            key = text if isinstance(text, str) else ''
+            ids = parsed.get(key)
+            if ids is None:
+                ids = parsed[key] = self._parse(key)
+            per_row.append(ids)
+        indptr = np.zeros(len(per_row) + 1, dtype=np.int64)
+        np.cumsum([len(ids) for ids in per_row], out=indptr[1:])
+        data = np.concatenate(per_row) if per_row else _EMPTY
+        return data.astype(np.int32, copy=False), indptr
+
+    def tokens(self, doc):
+        """Normalized tags of a string or of an id array; the TF-IDF analyzer"""
+        ids = doc if isinstance(doc, np.ndarray) else self.ids(doc)
+        return [self.tags[tag_id] for tag_id in ids]
+
+    def labels_of(self, ids):
+        return [self.labels[tag_id] for tag_id in ids]
+
+    @staticmethod
+    def common(ids, other_ids):
+        """Ids present in both, in the order of ids"""
+        return ids[np.isin(ids, other_ids)]
+
+
+_vocabulary = TagVocabulary()
+
+
+def get_tag_vocabulary():
+    """The process vocabulary: used by new fits and for profiles no model holds"""
+    return _vocabulary
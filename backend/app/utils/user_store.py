@@ -0,0 +1,218 @@
+"""
+Columnar user store for the recommender serving path
+
+One growable NumPy array per profile field plus a uid -> row hash index,
+so a recommendation request never touches pandas. Given a TagVocabulary,
+the store also keeps every row's interest tags as interned int32 ids (CSR:
+one id buffer plus per-row start/end), which the recommender, tag index
+and AI service read instead of re-parsing the text.
+"""
+import math
+import sys
+
+import numpy as np
+
+
+# Fields returned with every recommendation (see MatchRecommendation)
+SERVING_FIELDS = ['uid', 'name', 'gender', 'age', 'interest_tags']
+
+# Low-cardinality text fields: one shared str object per distinct value in compact mode
+INTERNED_FIELDS = ['gender', 'interest_tags']
+
+
+def grow_array(arr, needed):
+    """Return arr with capacity >= needed, doubling so appends stay amortized O(1)"""
+    if len(arr) >= needed:
+        return arr
+    grown = np.empty((max(needed, 2 * len(arr), 16),) + arr.shape[1:], dtype=arr.dtype)
+    grown[:len(arr)] = arr
+    return grown
+
+
+def _clean_age(value):
+    try:
+        age = float(value)
+    except (TypeError, ValueError):
+        return math.nan
+    return age
+
+
+class UserStore:
+    """Row-aligned arrays for the fields served with each recommendation"""
+
+    def __init__(self, fields=SERVING_FIELDS, interned=(), tag_vocabulary=None):
+        self.fields = list(fields)
+        self.columns = {field: self._empty(field, 0) for field in self.fields}
+        self.index = {}     # uid -> live row
+        self.n_rows = 0
+        self.interned = [field for field in interned if field in self.fields]
+        self._pool = {}     # value -> the one shared object for interned fields
+
+        # Per-row tag ids: row r's ids are tag_data[tag_start[r]:tag_end[r]].
+        # An edit that lists more tags than the row had appends to tag_data;
+        # the slot it leaves behind is reclaimed by compact().
+        self.tag_vocabulary = tag_vocabulary if 'interest_tags' in self.fields else None
+        self.tag_data = np.empty(0, dtype=np.int32)
+        self.tag_start = np.empty(0, dtype=np.int64)
+        self.tag_end = np.empty(0, dtype=np.int64)
+        self._tag_len = 0   # used length of tag_data
+
+    @staticmethod
+    def _empty(field, capacity):
+        if field == 'age':
+            return np.full(capacity, np.nan, dtype=np.float32)
+        return np.empty(capacity, dtype=object)
+
+    @classmethod
+    def from_frame(cls, df, fields=SERVING_FIELDS, interned=(), tag_vocabulary=None, tag_ids=None):
+        """
+        Build from a DataFrame; row i of the store is row i of df. tag_ids
+        is the interest_tags column already parsed by tag_vocabulary
+        (TagVocabulary.parse_column()), parsed here when not given
+        """
+        store = cls(fields, interned, tag_vocabulary)
+        for field in store.fields:
+            if field not in df:
+                store.columns[field] = store._empty(field, len(df))
+            elif field == 'age':
+                store.columns[field] = np.array([_clean_age(v) for v in df[field]], dtype=np.float32)
+            elif field in store.interned:
+                store.columns[field] = np.array([store._intern(v) for v in df[field]], dtype=object)
+            else:
+                store.columns[field] = df[field].to_numpy(dtype=object, copy=True)
+        store.n_rows = len(df)
+        store.index = {uid: i for i, uid in enumerate(store.columns['uid'])}
+        if store.tag_vocabulary is not None:
+            if tag_ids is None:
+                tag_ids = store.tag_vocabulary.parse_column(store.columns['interest_tags'])
+            store._set_tags(*tag_ids)
+        return store
+
+    def _set_tags(self, data, indptr):
+        self.tag_data = np.ascontiguousarray(data, dtype=np.int32)
+        self.tag_start = indptr[:-1].astype(np.int64)
+        self.tag_end = indptr[1:].astype(np.int64)
+        self._tag_len = len(self.tag_data)
+
+    def _intern(self, value):
+        try:
+            return self._pool.setdefault(value, value)
+        except TypeError:   # unhashable: stored as is
+            return value
+
+    def _write(self, row, record, new_row=False):
+        for field in self.fields:
+            value = record.get(field)
+            if field == 'age':
+                value = _clean_age(value)
+            elif field in self.interned:
+                value = self._intern(value)
+            self.columns[field][row] = value
+        if self.tag_vocabulary is not None:
+            self._write_tags(row, self.tag_vocabulary.ids(record.get('interest_tags')), new_row)
+
+    def _write_tags(self, row, ids, new_row):
+        start = self.tag_start[row]
+        if new_row or len(ids) > self.tag_end[row] - start:
+            start = self._tag_len
+            self._tag_len += len(ids)
+            self.tag_data = grow_array(self.tag_data, self._tag_len)
+        self.tag_data[start:start + len(ids)] = ids
+        self.tag_start[row] = start
+        self.tag_end[row] = start + len(ids)
+
+    def append(self, record):
+        row = self.n_rows
+        for field in self.fields:
+            self.columns[field] = grow_array(self.columns[field], row + 1)
+        if self.tag_vocabulary is not None:
+            self.tag_start = grow_array(self.tag_start, row + 1)
+            self.tag_end = grow_array(self.tag_end, row + 1)
+        self._write(row, record, new_row=True)
+        self.n_rows = row + 1
+        self.index[record['uid']] = row
+        return row
+
+    def update(self, row, record):
+        self._write(row, record)
+        self.index[record['uid']] = row
+
+    def remove(self, uid):
+        """Forget a uid; its row stays in the arrays until compact()"""
+        return self.index.pop(uid, None)
+
+    def column(self, field):
+        return self.columns[field][:self.n_rows]
+
+    def tag_ids(self, row):
+        """int32 tag ids of a row's interest_tags, in listed order (a view)"""
+        return self.tag_data[self.tag_start[row]:self.tag_end[row]]
+
+    def tag_csr(self, rows=None):
+        """
+        Tag ids of the given rows (all rows when None) as CSR: (int32 ids,
+        int64 indptr), gathered without a Python loop
+        """
+        if rows is None:
+            rows = slice(0, self.n_rows)
+        starts, ends = self.tag_start[rows], self.tag_end[rows]
+        lengths = ends - starts
+        indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        # Position k of the output reads tag_data[starts[r] + (k - indptr[r])]
+        gather = np.arange(indptr[-1], dtype=np.int64) + np.repeat(starts - indptr[:-1], lengths)
+        return self.tag_data[gather], indptr
+
+    def records(self, rows, scores=None):
+        """Plain dicts for the given rows, ready for MatchRecommendation"""
+        out = []
+        for i, row in enumerate(rows):
+            record = {field: self.columns[field][row] for field in self.fields}
+            if 'age' in record:
+                age = record['age']
+                record['age'] = None if math.isnan(age) else int(age)
+            if scores is not None:
+                record['similarity_score'] = float(scores[i])
+            out.append(record)
+        return out
+
+    def nbytes(self):
+        """Bytes per column (object columns: pointers + each distinct object once) and the uid index"""
+        sizes = {}
+        for field, column in self.columns.items():
+            size = column.nbytes
+            if column.dtype == object:
+                seen = set()
+                for value in column[:self.n_rows]:
+                    if id(value) not in seen:
+                        seen.add(id(value))
+                        size += sys.getsizeof(value)
+            sizes[field] = size
+        if self.tag_vocabulary is not None:
+            sizes['interest_tag_ids'] = self.tag_data.nbytes + self.tag_start.nbytes + self.tag_end.nbytes
+        sizes['index'] = sys.getsizeof(self.index)
+        return sizes
+
+    def __getstate__(self):
+        # Drop spare capacity when pickled (snapshots)
+        state = self.__dict__.copy()
+        state['columns'] = {field: col[:self.n_rows].copy() for field, col in self.columns.items()}
+        if self.tag_vocabulary is not None:
+            data, indptr = self.tag_csr()
+            state.update(tag_data=data, tag_start=indptr[:-1].copy(), tag_end=indptr[1:].copy(),
+                         _tag_len=len(data))
+        return state
+
+    def compact(self, live):
+        """Keep only the given rows (sorted), renumbered from 0"""
+        for field in self.fields:
+            self.columns[field] = self.columns[field][live]
+        if self.tag_vocabulary is not None:
+            self._set_tags(*self.tag_csr(live))
+        self.n_rows = len(live)
+        self.index = {uid: i for i, uid in enumerate(self.columns['uid'])}
+        # Forget values no live row uses any more
+        self._pool = {}
+        for field in self.interned:
+            for value in self.columns[field]:
+                self._intern(value)
@@ -32,6 +32,9 @@ app = FastAPI(
 async def startup_event():
     print("🚀 Starting AI Dating App Backend...")
     initialize_firebase()
+    if recommend_available:
+        # Load/fit the recommender off the request path
+        recommend.start_recommender_refresher()
     print("✅ Backend startup complete")
 
 # CORS
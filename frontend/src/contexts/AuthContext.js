@@ -42,7 +42,8 @@ export const AuthProvider = ({ children }) => {
         education_level: profileData.education_level || '',
         interest_tags: profileData.interest_tags || '',
         createdAt: new Date().toISOString(),
-        lastActive: new Date().toISOString()
+        lastActive: new Date().toISOString(),
+        updatedAt: new Date().toISOString()
       });
 
       return user;